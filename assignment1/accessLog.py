@@ -0,0 +1,145 @@
+# Access log and in-process metrics for the web server.
+#
+# Request threads only put a record on a queue; a QueueListener thread
+# formats it as one JSON line and does the (blocking) write. Metrics keep
+# request counts per path and status and a latency histogram, and are
+# rendered in the Prometheus text format by the /metrics endpoint. With
+# several worker processes each one reports its own numbers.
+
+from collections import Counter
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_TRACKED_PATHS = 1000  # further paths are counted under "other"
+
+
+class CountingSocket:
+    # Wraps a connection socket to count the bytes sent and capture the
+    # status code of the response line.
+    def __init__(self, connectionSocket):
+        self._sock = connectionSocket
+        self.bytesSent = 0
+        self.status = None
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def _sniff(self, data):
+        if self.status is None and data[:5] == b'HTTP/':
+            parts = bytes(data[:16]).split()
+            if len(parts) > 1 and parts[1].isdigit():
+                self.status = int(parts[1])
+
+    def send(self, data, *args):
+        self._sniff(data)
+        n = self._sock.send(data, *args)
+        self.bytesSent += n
+        return n
+
+    def sendall(self, data, *args):
+        self._sniff(data)
+        self._sock.sendall(data, *args)
+        self.bytesSent += len(data)
+
+    def sendfile(self, f, offset=0, count=None):
+        n = self._sock.sendfile(f, offset, count)
+        self.bytesSent += n
+        return n
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}
+        entry.update(record.access)
+        return json.dumps(entry)
+
+
+class Metrics:
+    def __init__(self):
+        self.startTime = time.time()
+        self.requests = Counter()  # (path, status) -> count
+        self.bucketCounts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latencySum = 0.0
+        self.bytesSent = 0
+        self._paths = set()
+        self._lock = threading.Lock()
+
+    def observe(self, path, status, nbytes, duration):
+        with self._lock:
+            if path not in self._paths:
+                if len(self._paths) >= MAX_TRACKED_PATHS:
+                    path = 'other'
+                else:
+                    self._paths.add(path)
+            self.requests[(path, status)] += 1
+            i = 0
+            while i < len(LATENCY_BUCKETS) and duration > LATENCY_BUCKETS[i]:
+                i += 1
+            self.bucketCounts[i] += 1
+            self.latencySum += duration
+            self.bytesSent += nbytes
+
+    def render(self):
+        with self._lock:
+            requests = sorted(self.requests.items(), key=lambda item: -item[1])
+            bucketCounts = list(self.bucketCounts)
+            latencySum = self.latencySum
+            bytesSent = self.bytesSent
+        lines = ['# TYPE http_requests_total counter']
+        for (path, status), count in requests:
+            lines.append('http_requests_total{path=%s,status="%s"} %d'
+                         % (json.dumps(path), status, count))
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), bucketCounts):
+            cumulative += count
+            lines.append('http_request_duration_seconds_bucket{le="%s"} %d' % (bound, cumulative))
+        lines.append('http_request_duration_seconds_sum %.6f' % latencySum)
+        lines.append('http_request_duration_seconds_count %d' % cumulative)
+        lines.append('# TYPE http_response_bytes_total counter')
+        lines.append('http_response_bytes_total %d' % bytesSent)
+        lines.append('# TYPE process_uptime_seconds gauge')
+        lines.append('process_uptime_seconds %.3f' % (time.time() - self.startTime))
+        return '\n'.join(lines) + '\n'
+
+
+class AccessLog:
+    def __init__(self, path='-'):
+        # The queue is unbounded so that logging never blocks a request
+        self._queue = queue.SimpleQueue()
+        if path == '-':
+            handler = logging.StreamHandler(sys.stdout)
+        else:
+            handler = logging.FileHandler(path)
+        handler.setFormatter(JsonFormatter())
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        self._logger = logging.Logger('access')
+        self._logger.addHandler(logging.handlers.QueueHandler(self._queue))
+        self.metrics = Metrics()
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        # Writes the records still queued
+        self._listener.stop()
+
+    def log(self, addr, request, status, nbytes, duration):
+        method = request.method if request is not None else '-'
+        path = request.path.partition('?')[0] if request is not None else '-'
+        self.metrics.observe(path, status, nbytes, duration)
+        self._logger.info('', extra={'access': {
+            'client': '%s:%s' % addr[:2],
+            'method': method,
+            'path': path,
+            'status': status,
+            'bytes': nbytes,
+            'duration_ms': round(duration * 1000, 3),
+        }})
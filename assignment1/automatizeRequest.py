@@ -1,17 +1,144 @@
-import subprocess
+from socket import *
+from collections import Counter
+import argparse
+import itertools
+import threading
+import time
 
-# Python script for test multi-thread server request
+# Python script for load testing the multi-thread server.
+# Requests are made in-process by a pool of threads, so the measurement
+# reflects the server and not the startup time of a new interpreter.
 requests = [
     ["localhost", "9595", "page.html"],
     ["localhost", "9595", "file2.html"],
 ]
 
-for req in requests:
-    serverHost, serverPort, filename = req
-    command = ["python", "webClient.py", serverHost, serverPort, filename]
-    print(f"Running command: {' '.join(command)}")
+
+def fetch(serverHost, serverPort, filename, timeoutSecs):
+    # Makes one GET request and returns (status code, bytes received)
+    clientSocket = create_connection((serverHost, serverPort), timeout=timeoutSecs)
     try:
-        output = subprocess.check_output(command, stderr=subprocess.STDOUT, text=True)
-        print(output)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {e}")
+        httpRequest = ("GET /" + filename + " HTTP/1.1\r\nHost: " + serverHost +
+                       "\r\nConnection: close\r\n\r\n")
+        clientSocket.sendall(httpRequest.encode())
+        data = bytearray()
+        while True:
+            newData = clientSocket.recv(65536)
+            if not newData:
+                break
+            data += newData
+    finally:
+        clientSocket.close()
+    statusLine = data[:data.find(b"\r\n")].split()
+    if len(statusLine) < 2 or not statusLine[1].isdigit():
+        raise ValueError("malformed response")
+    return int(statusLine[1]), len(data)
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = []  # type: list of float, seconds
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.bytesReceived = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, status, nbytes):
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            self.bytesReceived += nbytes
+
+    def record_error(self, error):
+        with self._lock:
+            self.errors[type(error).__name__] += 1
+
+
+def percentile(sortedValues, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sortedValues:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sortedValues))))
+    return sortedValues[rank - 1]
+
+
+def worker(targets, counter, numRequests, deadline, timeoutSecs, stats):
+    while True:
+        i = next(counter)
+        if (numRequests and i >= numRequests) or (deadline and time.perf_counter() >= deadline):
+            return
+        serverHost, serverPort, filename = targets[i % len(targets)]
+        start = time.perf_counter()
+        try:
+            status, nbytes = fetch(serverHost, int(serverPort), filename, timeoutSecs)
+        except (OSError, ValueError) as e:
+            stats.record_error(e)
+            continue
+        stats.record(time.perf_counter() - start, status, nbytes)
+
+
+def run(targets, concurrency, numRequests, duration, timeoutSecs):
+    stats = LoadStats()
+    counter = itertools.count()
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+    threads = [threading.Thread(target=worker,
+                                args=(targets, counter, numRequests, deadline, timeoutSecs, stats))
+               for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return stats, time.perf_counter() - start
+
+
+def report(stats, elapsed):
+    latencies = sorted(stats.latencies)
+    completed = len(latencies)
+    print("Load test report:")
+    print("Completed requests: %i" % completed)
+    print("Failed requests:    %i %s" % (sum(stats.errors.values()), dict(stats.errors)))
+    print("Status codes:       %s" % dict(sorted(stats.statuses.items())))
+    print("Elapsed time:       %.3f s" % elapsed)
+    print("Requests/sec:       %.1f" % (completed / elapsed if elapsed else 0.0))
+    print("Transfer rate:      %.1f KB/s" % (stats.bytesReceived / 1024.0 / elapsed if elapsed else 0.0))
+    if completed:
+        print("Latency (ms): min %.3f  p50 %.3f  p90 %.3f  p99 %.3f  max %.3f" % (
+            latencies[0] * 1000, percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, latencies[-1] * 1000))
+
+
+def parse_target(value):
+    # "host:port/path" -> [host, port, path]
+    address, _, filename = value.partition("/")
+    serverHost, _, serverPort = address.partition(":")
+    return [serverHost, serverPort or "80", filename]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent load generator for the web server.')
+    parser.add_argument('targets', nargs='*', type=parse_target,
+                        help='targets as host:port/path [default: %s]'
+                             % ' '.join('%s:%s/%s' % tuple(r) for r in requests))
+    parser.add_argument('-c', type=int, default=10,
+                        dest='concurrency',
+                        help='number of concurrent clients [int, default: %(default)s]')
+    parser.add_argument('-n', type=int, default=None,
+                        dest='num_requests',
+                        help=('total number of requests, 0 for no limit '
+                              '[int, default: 1000, no limit with -d]'))
+    parser.add_argument('-d', type=float, default=0.0,
+                        dest='duration',
+                        help='stop after this many seconds, 0 for no limit [float, default: %(default)s]')
+    parser.add_argument('-t', type=float, default=5.0,
+                        dest='timeout',
+                        help='per-request socket timeout in seconds [float, default: %(default)s]')
+    options = parser.parse_args()
+    if options.num_requests is None:
+        options.num_requests = 0 if options.duration else 1000
+    if not options.num_requests and not options.duration:
+        parser.error("either -n or -d must be non-zero")
+
+    stats, elapsed = run(options.targets or requests, options.concurrency,
+                         options.num_requests, options.duration, options.timeout)
+    report(stats, elapsed)
@@ -0,0 +1,40 @@
+import argparse
+import time
+
+from httpParser import HttpRequestParser
+
+# Python script for measuring the parse rate of httpParser.py
+REQUEST = (b"GET /page.html HTTP/1.1\r\n"
+           b"Host: localhost:9595\r\n"
+           b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0\r\n"
+           b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+           b"Accept-Language: es-ES,es;q=0.8,en-US;q=0.5,en;q=0.3\r\n"
+           b"Accept-Encoding: gzip, deflate\r\n"
+           b"Connection: keep-alive\r\n"
+           b"\r\n")
+
+
+def bench(name, numRequests, chunkSize):
+    # Feeds numRequests pipelined requests in chunks of chunkSize bytes
+    data = memoryview(REQUEST * numRequests)
+    parser = HttpRequestParser()
+    parsed = 0
+    start = time.perf_counter()
+    for i in range(0, len(data), chunkSize):
+        parsed += len(parser.feed(data[i:i + chunkSize]))
+    elapsed = time.perf_counter() - start
+    assert parsed == numRequests
+    print("%-22s %10.0f requests/s" % (name, parsed / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the incremental HTTP request parser.')
+    parser.add_argument('-n', type=int, default=100000,
+                        dest='num_requests',
+                        help='number of requests to parse [int, default: %(default)s]')
+    options = parser.parse_args()
+
+    bench("one request per feed", options.num_requests, len(REQUEST))
+    bench("4096-byte segments", options.num_requests, 4096)
+    bench("64-byte segments", options.num_requests, 64)
+    bench("1-byte segments", options.num_requests // 100, 1)
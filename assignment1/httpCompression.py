@@ -0,0 +1,98 @@
+# Content-Encoding negotiation and compressed-body cache for the web server.
+#
+# Text responses are sent gzip/deflate-encoded when the client accepts it.
+# A precompressed "<file>.gz" next to the original is preferred for gzip;
+# otherwise the body is compressed once and kept in an LRU cache keyed by the
+# file's path, modification time and size, so it is not recompressed on
+# every request.
+
+from collections import OrderedDict
+import gzip
+import os
+import threading
+import zlib
+
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'}
+MIN_COMPRESS_SIZE = 256  # smaller bodies barely shrink
+MAX_COMPRESS_SIZE = 4 * 1024 * 1024  # larger files are streamed as they are
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')  # in order of preference
+
+
+def is_compressible(contentType, size):
+    if not MIN_COMPRESS_SIZE <= size <= MAX_COMPRESS_SIZE:
+        return False
+    mimeType = contentType.partition(';')[0]
+    return mimeType.startswith('text/') or mimeType in COMPRESSIBLE_TYPES
+
+
+def negotiate_encoding(acceptEncoding):
+    # Picks the preferred supported coding with the highest q-value, or None
+    # for identity.
+    weights = {}
+    for item in acceptEncoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            weights[coding] = q
+    best, bestQ = None, 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if q > bestQ:
+            best, bestQ = coding, q
+    return best
+
+
+def find_precompressed(path, st):
+    # Returns the path of an up-to-date "<path>.gz" sibling, or None.
+    gzPath = path + '.gz'
+    try:
+        gzStat = os.stat(gzPath)
+    except OSError:
+        return None
+    if gzStat.st_mtime_ns < st.st_mtime_ns:
+        return None
+    return gzPath
+
+
+class CompressionCache:
+    MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, maxBytes=MAX_BYTES):
+        self.maxBytes = maxBytes
+        self.usedBytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, st, encoding, f):
+        # Returns the body of f compressed with encoding, compressing it only
+        # if this version of the file is not already cached.
+        key = (path, st.st_mtime_ns, st.st_size, encoding)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                return body
+
+        f.seek(0)
+        data = f.read()
+        if encoding == 'gzip':
+            body = gzip.compress(data, mtime=0)
+        else:
+            body = zlib.compress(data)
+
+        with self._lock:
+            if key not in self._entries and len(body) <= self.maxBytes:
+                self._entries[key] = body
+                self.usedBytes += len(body)
+                while self.usedBytes > self.maxBytes:
+                    _, old = self._entries.popitem(last=False)
+                    self.usedBytes -= len(old)
+        return body
@@ -0,0 +1,241 @@
+# Incremental HTTP/1.x request parser used by the web server, and the
+# response reader used by webClient.py.
+#
+# Data is fed as it arrives from the socket, so requests split across several
+# TCP segments (or several requests in one segment) are handled correctly.
+# Incoming bytes are accumulated in a single bytearray that is consumed in
+# place, and read_request() receives into a preallocated buffer.
+
+
+class HttpParseError(Exception):
+    def __init__(self, status, reason):
+        super().__init__('%d %s' % (status, reason))
+        self.status = status  # type: integer, HTTP status to answer with
+        self.reason = reason  # type: string
+
+
+class HttpRequest:
+    def __init__(self, method, path, version, headers):
+        self.method = method  # type: string
+        self.path = path  # type: string
+        self.version = version  # type: string
+        self.headers = headers  # type: dict, lower-cased names
+        self.body = b''  # type: bytes
+
+    def __str__(self):
+        return ('HttpRequest(method=%s, path=%s, version=%s, headers=%s, body=%d bytes)'
+                % (self.method, self.path, self.version, self.headers, len(self.body)))
+
+
+class HttpRequestParser:
+    MAX_HEADER_SIZE = 8192
+    MAX_BODY_SIZE = 1 << 20
+
+    def __init__(self, maxHeaderSize=MAX_HEADER_SIZE, maxBodySize=MAX_BODY_SIZE):
+        self.maxHeaderSize = maxHeaderSize
+        self.maxBodySize = maxBodySize
+
+        # State.
+        self._buf = bytearray()
+        self._scanFrom = 0  # where to resume looking for the end of the headers
+        self._pending = None  # request whose body is still arriving
+
+    def has_partial(self):
+        # True if some bytes of an unfinished request are buffered.
+        return self._pending is not None or len(self._buf.lstrip(b'\r\n')) > 0
+
+    def feed(self, data):
+        # Adds data to the buffer and returns the list of requests completed
+        # by it (possibly empty). Raises HttpParseError on malformed input.
+        self._buf += data
+        completed = []
+        while True:
+            if self._pending is None:
+                # Blank lines before a request line must be ignored (RFC 9112).
+                while self._buf[:2] == b'\r\n':
+                    del self._buf[:2]
+                    self._scanFrom = 0
+                end = self._buf.find(b'\r\n\r\n', max(0, self._scanFrom - 3))
+                if end < 0:
+                    if len(self._buf) > self.maxHeaderSize:
+                        raise HttpParseError(431, 'Request Header Fields Too Large')
+                    self._scanFrom = len(self._buf)
+                    break
+                if end + 4 > self.maxHeaderSize:
+                    raise HttpParseError(431, 'Request Header Fields Too Large')
+                self._pending = self._parse_head(self._buf[:end].decode('latin-1'))
+                del self._buf[:end + 4]
+                self._scanFrom = 0
+
+            request = self._pending
+            length = self._content_length(request.headers)
+            if len(self._buf) < length:
+                break
+            request.body = bytes(self._buf[:length])
+            del self._buf[:length]
+            self._pending = None
+            completed.append(request)
+        return completed
+
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HttpParseError(400, 'Bad Request')
+        method, path, version = parts
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            name = name.strip().lower()
+            if not sep or not name:
+                raise HttpParseError(400, 'Bad Request')
+            value = value.strip()
+            if name in headers:
+                headers[name] += ', ' + value
+            else:
+                headers[name] = value
+        return HttpRequest(method, path, version, headers)
+
+    def _content_length(self, headers):
+        if 'transfer-encoding' in headers:
+            raise HttpParseError(501, 'Not Implemented')
+        value = headers.get('content-length', '0')
+        if not (value.isascii() and value.isdigit()):
+            raise HttpParseError(400, 'Bad Request')
+        length = int(value)
+        if length > self.maxBodySize:
+            raise HttpParseError(413, 'Content Too Large')
+        return length
+
+
+def read_request(connectionSocket, parser=None, bufSize=4096):
+    # Reads from the socket until a full request has been parsed. Returns None
+    # if the peer closed the connection before sending anything.
+    if parser is None:
+        parser = HttpRequestParser()
+    recvBuf = bytearray(bufSize)
+    view = memoryview(recvBuf)
+    while True:
+        n = connectionSocket.recv_into(recvBuf)
+        if n == 0:
+            if parser.has_partial():
+                raise HttpParseError(400, 'Bad Request')
+            return None
+        requests = parser.feed(view[:n])
+        if requests:
+            return requests[0]
+
+
+class HttpResponse:
+    def __init__(self, version, status, reason, headers):
+        self.version = version  # type: string
+        self.status = status  # type: integer
+        self.reason = reason  # type: string
+        self.headers = headers  # type: dict, lower-cased names
+        self.body = bytearray()  # type: bytearray, empty if streamed to a file
+        self.bodySize = 0  # type: integer
+
+    def __str__(self):
+        return ('HttpResponse(version=%s, status=%s, reason=%s, headers=%s, body=%d bytes)'
+                % (self.version, self.status, self.reason, self.headers, self.bodySize))
+
+
+class _SocketStream:
+    # Buffered reads from a socket. Bytes past the headers are kept in a
+    # bytearray; large bodies are received straight into a reusable buffer
+    # and handed to the sink without further copies.
+    def __init__(self, connectionSocket, bufSize):
+        self.connectionSocket = connectionSocket
+        self.buf = bytearray()
+        self.recvBuf = bytearray(bufSize)
+        self.view = memoryview(self.recvBuf)
+
+    def read_until(self, delim, limit):
+        start = 0
+        while True:
+            i = self.buf.find(delim, start)
+            if i >= 0:
+                data = bytes(self.buf[:i])
+                del self.buf[:i + len(delim)]
+                return data
+            if len(self.buf) > limit:
+                raise HttpParseError(502, 'Bad Gateway')
+            start = max(0, len(self.buf) - len(delim) + 1)
+            n = self.connectionSocket.recv_into(self.recvBuf)
+            if n == 0:
+                raise HttpParseError(502, 'Bad Gateway')
+            self.buf += self.view[:n]
+
+    def copy(self, remaining, sink):
+        # Passes the next `remaining` bytes (or everything until the peer
+        # closes, if None) to sink. Returns the number of bytes copied.
+        copied = 0
+        while remaining is None or remaining > 0:
+            if self.buf:
+                take = len(self.buf) if remaining is None else min(remaining, len(self.buf))
+                sink(self.buf[:take])
+                del self.buf[:take]
+            else:
+                want = len(self.recvBuf) if remaining is None else min(remaining, len(self.recvBuf))
+                take = self.connectionSocket.recv_into(self.recvBuf, want)
+                if take == 0:
+                    if remaining is None:
+                        break
+                    raise HttpParseError(502, 'Bad Gateway')
+                sink(self.view[:take])
+            copied += take
+            if remaining is not None:
+                remaining -= take
+        return copied
+
+
+def read_response(connectionSocket, out=None, maxHeaderSize=HttpRequestParser.MAX_HEADER_SIZE,
+                  bufSize=65536):
+    # Reads one response. The body length comes from Transfer-Encoding:
+    # chunked, Content-Length or, failing both, the peer closing the
+    # connection. The body is written to the file object out if given,
+    # otherwise accumulated in response.body.
+    stream = _SocketStream(connectionSocket, bufSize)
+    head = stream.read_until(b'\r\n\r\n', maxHeaderSize).decode('latin-1')
+    lines = head.split('\r\n')
+    parts = lines[0].split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/') or not (parts[1].isascii() and parts[1].isdigit()):
+        raise HttpParseError(502, 'Bad Gateway')
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HttpParseError(502, 'Bad Gateway')
+        name = name.strip().lower()
+        if name in headers:
+            headers[name] += ', ' + value.strip()
+        else:
+            headers[name] = value.strip()
+    response = HttpResponse(parts[0], int(parts[1]), parts[2] if len(parts) > 2 else '', headers)
+    sink = response.body.extend if out is None else out.write
+
+    if response.status < 200 or response.status in (204, 304):
+        return response
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            sizeLine = stream.read_until(b'\r\n', 1024).split(b';')[0].strip()
+            try:
+                size = int(sizeLine, 16)
+            except ValueError:
+                raise HttpParseError(502, 'Bad Gateway')
+            if size == 0:
+                # Skip the trailer section
+                while stream.read_until(b'\r\n', maxHeaderSize):
+                    pass
+                break
+            response.bodySize += stream.copy(size, sink)
+            stream.read_until(b'\r\n', 2)
+    elif 'content-length' in headers:
+        length = headers['content-length']
+        if not (length.isascii() and length.isdigit()):
+            raise HttpParseError(502, 'Bad Gateway')
+        response.bodySize = stream.copy(int(length), sink)
+    else:
+        response.bodySize = stream.copy(None, sink)
+    return response
@@ -1,14 +1,17 @@
 from socket import *
 import sys
 
-# Checking to see if we do have four arguments
-if len(sys.argv) != 4:
+from httpParser import HttpParseError, read_response
+
+# Checking to see if we do have four (or five) arguments
+if len(sys.argv) not in (4, 5):
     print("Wrong number of arguments.")
-    print("Use: webClient.py <server_host> <server_port> <filename>")
+    print("Use: webClient.py <server_host> <server_port> <filename> [output_file]")
     sys.exit()
 
 # Preparing the socket
-serverHost, serverPort, filename = sys.argv[1:]
+serverHost, serverPort, filename = sys.argv[1:4]
+outputFile = sys.argv[4] if len(sys.argv) == 5 else None
 clientSocket = socket(AF_INET, SOCK_STREAM)
 try:
     clientSocket.connect((serverHost, int(serverPort)))
@@ -19,24 +22,37 @@ except:  # In case the server is not available
 print("Connection OK.")
 
 # Sending the HTTP request
-httpRequest = "GET /" + filename + " HTTP/1.1\r\n\r\n"
-clientSocket.send(httpRequest.encode())
+httpRequest = "GET /" + filename + " HTTP/1.1\r\nHost: " + serverHost + "\r\n\r\n"
+clientSocket.sendall(httpRequest.encode())
 print("Request message sent.")
 
 # Recieving the response
 print("Server HTTP Response:\r\n")
 
-# This loop is necessary because we don't know if the entire message will be
-# recieved at the same recv() call. If there is a timeout and no new data has
-# arrived, we have the entire response.
-data = ""
-while True:
-    clientSocket.settimeout(5)
-    newData = clientSocket.recv(1024).decode()
-    data += newData
-    if len(newData) == 0:
-        break
-print(data)
+# The response ends when Content-Length bytes (or the last chunk of a
+# chunked body) have arrived, so there is no need to wait for a timeout.
+# The body is kept as bytes until complete, so multibyte characters split
+# across segments are decoded correctly.
+clientSocket.settimeout(5)
+try:
+    if outputFile is None:
+        response = read_response(clientSocket)
+    else:
+        with open(outputFile, "wb") as out:
+            response = read_response(clientSocket, out)
+except (HttpParseError, OSError) as e:
+    print("Error reading the response: %s" % e)
+    clientSocket.close()
+    sys.exit()
+
+print("%s %d %s" % (response.version, response.status, response.reason))
+for name, value in response.headers.items():
+    print("%s: %s" % (name, value))
+print()
+if outputFile is None:
+    print(response.body.decode("utf-8", errors="replace"))
+else:
+    print("%d bytes saved to %s" % (response.bodySize, outputFile))
 
 # Closing socket and ending the program
 print("Closing socket . . .")
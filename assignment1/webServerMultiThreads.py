@@ -1,63 +1,388 @@
 from socket import *
+import argparse
+import mimetypes
+import os
+import signal
 import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from accessLog import AccessLog, CountingSocket
+from httpCompression import CompressionCache, find_precompressed, is_compressible, negotiate_encoding
+from httpParser import HttpParseError, read_request
+
+# Tiempo máximo (segundos) para recibir la solicitud completa
+REQUEST_TIMEOUT = 10
+
+# Tabla precalculada extensión -> Content-Type
+CONTENT_TYPES = {ext: (mimeType + "; charset=utf-8" if mimeType.startswith("text/") else mimeType)
+                 for ext, mimeType in mimetypes.types_map.items()}
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# Cuerpos ya comprimidos, compartidos por todos los hilos del proceso
+compressionCache = CompressionCache()
+
+# Ruta reservada para consultar las métricas del proceso
+METRICS_PATH = "/metrics"
+
+# Log de acceso del proceso; se crea en main() o en cada trabajador
+accessLog = None
+
+
+def send_status(connectionSocket, status, reason):
+    # Respuesta mínima para solicitudes que no se pudieron interpretar
+    body = ("<html><body><h1>%d %s</h1></body></html>" % (status, reason)).encode()
+    headers = ("HTTP/1.1 %d %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+               % (status, reason, len(body)))
+    connectionSocket.sendall(headers.encode() + body)
 
 
 def handle_client(connectionSocket, addr):
+    # Atiende la conexión y la registra en el log de acceso y las métricas
+    startTime = time.perf_counter()
+    countingSocket = CountingSocket(connectionSocket)
+    request = serve_client(countingSocket)
+    if countingSocket.status is not None:
+        accessLog.log(addr, request, countingSocket.status, countingSocket.bytesSent,
+                      time.perf_counter() - startTime)
+
+
+def serve_client(connectionSocket):
+    # Recibe la solicitud completa aunque llegue en varios segmentos TCP
+    connectionSocket.settimeout(REQUEST_TIMEOUT)
+    try:
+        request = read_request(connectionSocket)
+    except HttpParseError as e:
+        try:
+            send_status(connectionSocket, e.status, e.reason)
+        except OSError:
+            pass
+        connectionSocket.close()
+        return None
+    except OSError:
+        connectionSocket.close()
+        return None
+    if request is None:
+        # El cliente cerró la conexión sin enviar nada
+        connectionSocket.close()
+        return None
+
+    # Verifica el nombre del archivo
+    filename = request.path.partition('?')[0]
+    if filename == METRICS_PATH:
+        try:
+            body = accessLog.metrics.render().encode()
+            send_headers(connectionSocket, 200, "OK", {
+                "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                "Content-Length": str(len(body)),
+                "Connection": "close",
+            })
+            connectionSocket.sendall(body)
+        except OSError:
+            pass
+        finally:
+            connectionSocket.close()
+        return request
+
     try:
-        # Recibe el mensaje y verifica el nombre del archivo
-        message = connectionSocket.recv(2048).decode()
-        filename = message.split()[1]
-        f = open(filename[1:], 'r')
-        outputdata = f.read()
-
-        print("File found.")
-        # Devuelve la línea de encabezado informando que el archivo fue encontrado
-        headerLine = "HTTP/1.1 200 OK\r\n"
-        connectionSocket.send(headerLine.encode())
-        connectionSocket.send("\r\n".encode())
-
-        # Envía el archivo
-        for i in range(0, len(outputdata)):
-            connectionSocket.send(outputdata[i].encode())
-        connectionSocket.send("\r\n".encode())
+        f = open(filename[1:], 'rb')
+    except (IOError, ValueError):
+        # ValueError: la ruta contiene un byte NUL
+        try:
+            # Devuelve el encabezado de error y la página de error al navegador
+            with open("notfound.html", 'rb') as ferr:
+                outputerr = ferr.read()
+            send_headers(connectionSocket, 404, "Not Found", {
+                "Content-Type": CONTENT_TYPES[".html"],
+                "Content-Length": str(len(outputerr)),
+                "Connection": "close",
+            })
+            if request.method != 'HEAD':
+                connectionSocket.sendall(outputerr)
+        except OSError as e:
+            print("Warning: connection error: %s" % e)
+        finally:
+            # Finaliza la conexión
+            connectionSocket.close()
+        return request
 
+    try:
+        with f:
+            send_file(connectionSocket, request, filename[1:], f)
+    except OSError as e:
+        print("Warning: connection error: %s" % e)
+    finally:
         # Finaliza la conexión
-        print("File sent.")
         connectionSocket.close()
+    return request
 
-    except IOError:
-        print("Warning: file not found.")
 
-        # Devuelve el encabezado de error al navegador
-        errHeader = "HTTP/1.1 404 Not Found\r\n"
-        connectionSocket.send(errHeader.encode())
-        connectionSocket.send("\r\n".encode())
+def send_headers(connectionSocket, status, reason, headers):
+    lines = ["HTTP/1.1 %d %s" % (status, reason)]
+    lines += ["%s: %s" % item for item in headers.items()]
+    connectionSocket.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
 
-        # Abre y envía la página de error al navegador
-        ferr = open("notfound.html", 'r')
-        outputerr = ferr.read()
 
-        for i in range(0, len(outputerr)):
-            connectionSocket.send(outputerr[i].encode())
-        connectionSocket.send("\r\n".encode())
+def send_file(connectionSocket, request, path, f):
+    # Validadores para GET condicional: fecha de modificación y ETag
+    st = os.fstat(f.fileno())
+    etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+    lastModified = formatdate(st.st_mtime, usegmt=True)
+    contentType = CONTENT_TYPES.get(os.path.splitext(path)[1].lower(), DEFAULT_CONTENT_TYPE)
+    headers = {
+        "Content-Type": contentType,
+        "Last-Modified": lastModified,
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Connection": "close",
+    }
 
-        # Finaliza la conexión
-        print("Error message sent.")
-        connectionSocket.close()
+    # Negociación de Content-Encoding para archivos de texto (no se combina con Range)
+    encoding = None
+    if is_compressible(contentType, st.st_size):
+        headers["Vary"] = "Accept-Encoding"
+        if 'range' not in request.headers:
+            encoding = negotiate_encoding(request.headers.get('accept-encoding', ''))
+    if encoding is not None:
+        # Cada codificación es una representación distinta con su propio ETag
+        headers["ETag"] = etag = etag[:-1] + '-' + encoding + '"'
+        headers["Content-Encoding"] = encoding
+
+    if is_not_modified(request.headers, etag, st.st_mtime):
+        send_headers(connectionSocket, 304, "Not Modified", headers)
+        return
+
+    if encoding is not None:
+        send_encoded(connectionSocket, request, path, f, st, encoding, headers)
+        return
+
+    # Solicitud parcial (Range); If-Range solo la permite si el archivo no cambió
+    size = st.st_size
+    start, end = 0, size - 1
+    status, reason = 200, "OK"
+    ifRange = request.headers.get('if-range')
+    if 'range' in request.headers and ifRange in (None, etag, lastModified):
+        try:
+            byteRange = parse_range(request.headers['range'], size)
+        except ValueError:
+            headers["Content-Range"] = "bytes */%d" % size
+            headers["Content-Length"] = "0"
+            send_headers(connectionSocket, 416, "Range Not Satisfiable", headers)
+            return
+        if byteRange is not None:
+            start, end = byteRange
+            status, reason = 206, "Partial Content"
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+
+    headers["Content-Length"] = str(end - start + 1)
+    send_headers(connectionSocket, status, reason, headers)
+    if request.method != 'HEAD' and end >= start:
+        # Envía solo la porción pedida leyendo desde el desplazamiento en el
+        # archivo; sendfile la transmite por bloques, sin cargarla en memoria
+        connectionSocket.sendfile(f, offset=start, count=end - start + 1)
+
+
+def send_encoded(connectionSocket, request, path, f, st, encoding, headers):
+    # Usa el archivo .gz precomprimido si existe; si no, la caché en memoria
+    gzPath = find_precompressed(path, st) if encoding == 'gzip' else None
+    if gzPath is not None:
+        with open(gzPath, 'rb') as gz:
+            headers["Content-Length"] = str(os.fstat(gz.fileno()).st_size)
+            send_headers(connectionSocket, 200, "OK", headers)
+            if request.method != 'HEAD':
+                connectionSocket.sendfile(gz)
+        return
+
+    body = compressionCache.get(path, st, encoding, f)
+    headers["Content-Length"] = str(len(body))
+    send_headers(connectionSocket, 200, "OK", headers)
+    if request.method != 'HEAD':
+        connectionSocket.sendall(body)
 
 
-# Configuración del servidor
-serverSocket = socket(AF_INET, SOCK_STREAM)
-serverPort = 9595
-serverSocket.bind(('', serverPort))
-serverSocket.listen(5)
-print("Ready to serve . . .")
+def is_not_modified(requestHeaders, etag, mtime):
+    # If-None-Match tiene prioridad sobre If-Modified-Since (RFC 9110)
+    ifNoneMatch = requestHeaders.get('if-none-match')
+    if ifNoneMatch is not None:
+        tags = [t.strip().removeprefix('W/') for t in ifNoneMatch.split(',')]
+        return '*' in tags or etag in tags
+    ifModifiedSince = requestHeaders.get('if-modified-since')
+    if ifModifiedSince is not None:
+        try:
+            since = parsedate_to_datetime(ifModifiedSince).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def parse_range(value, size):
+    # Interpreta "bytes=a-b", "bytes=a-" y "bytes=-n". Devuelve (inicio, fin)
+    # inclusivo, o None si el encabezado debe ignorarse (sintaxis inválida o
+    # varios rangos). Lanza ValueError si el rango no se puede satisfacer.
+    unit, sep, spec = value.partition('=')
+    if unit.strip() != 'bytes' or not sep or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not all(part == '' or part.isascii() and part.isdigit() for part in (first, last)):
+        return None
+    if first == '':
+        if last == '':
+            return None
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, min(end, size - 1)
+
+
+def create_server_socket(serverPort, reusePort=False):
+    # Crea el socket de escucha; con reusePort varios procesos pueden
+    # enlazarse al mismo puerto y el kernel reparte las conexiones entre ellos
+    serverSocket = socket(AF_INET, SOCK_STREAM)
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reusePort:
+        serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    serverSocket.bind(('', serverPort))
+    serverSocket.listen(128)
+    return serverSocket
+
+
+def serve_forever(serverSocket, stopEvent):
+    # Función principal para aceptar solicitudes y crear subprocesos.
+    # El timeout permite revisar periódicamente si se pidió terminar.
+    serverSocket.settimeout(0.5)
+    while not stopEvent.is_set():
+        try:
+            connectionSocket, addr = serverSocket.accept()
+        except timeout:
+            continue
+        except OSError:
+            break
+
+        # Crear un nuevo hilo para manejar la solicitud del cliente
+        client_thread = threading.Thread(target=handle_client, args=(connectionSocket, addr))
+        client_thread.start()
+    serverSocket.close()
+
+
+def start_access_log(accessLogPath):
+    global accessLog
+    accessLog = AccessLog(accessLogPath)
+    accessLog.start()
+
+
+def run_worker(serverSocket, serverPort, accessLogPath):
+    # Proceso hijo: si no heredó un socket abre el suyo con SO_REUSEPORT
+    start_access_log(accessLogPath)
+    stopEvent = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if serverSocket is None:
+        serverSocket = create_server_socket(serverPort, reusePort=True)
+    print("Worker %d ready to serve . . ." % os.getpid())
+    serve_forever(serverSocket, stopEvent)
+
+    # Cierre ordenado: espera a que terminen las solicitudes en curso
+    for t in threading.enumerate():
+        if t is not threading.main_thread() and not t.daemon:
+            t.join(timeout=10)
+    accessLog.stop()
+    os._exit(0)
+
+
+def spawn_worker(serverSocket, serverPort, accessLogPath):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(serverSocket, serverPort, accessLogPath)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def run_prefork(serverPort, numWorkers, accessLogPath):
+    # Proceso maestro: crea los trabajadores, los reinicia si mueren y
+    # los detiene ordenadamente al recibir SIGINT/SIGTERM
+    serverSocket = None
+    if 'SO_REUSEPORT' not in globals():
+        # Sin SO_REUSEPORT los hijos heredan un único socket compartido
+        serverSocket = create_server_socket(serverPort)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    workers = {}
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(numWorkers):
+        workers[spawn_worker(serverSocket, serverPort, accessLogPath)] = time.monotonic()
+    print("Ready to serve with %d workers . . ." % numWorkers)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        startedAt = workers.pop(pid, None)
+        if startedAt is None or stopping:
+            continue
+        print("Worker %d exited (status %d), restarting." % (pid, status))
+        # Evita reiniciar en bucle un trabajador que falla al arrancar
+        if time.monotonic() - startedAt < 1:
+            time.sleep(1)
+        if not stopping:
+            workers[spawn_worker(serverSocket, serverPort, accessLogPath)] = time.monotonic()
+
+    if serverSocket is not None:
+        serverSocket.close()
+    print("Server stopped.")
+
+
+def main(options):
+    if options.workers > 1 and hasattr(os, 'fork'):
+        run_prefork(options.port, options.workers, options.access_log)
+        return
+
+    # Configuración del servidor en un solo proceso
+    start_access_log(options.access_log)
+    stopEvent = threading.Event()
+    serverSocket = create_server_socket(options.port)
+    print("Ready to serve . . .")
+    try:
+        serve_forever(serverSocket, stopEvent)
+    except KeyboardInterrupt:
+        stopEvent.set()
+        serverSocket.close()
+    finally:
+        accessLog.stop()
 
-# Función principal para aceptar solicitudes y crear subprocesos
-while True:
-    connectionSocket, addr = serverSocket.accept()
-    print("Request accepted from (address, port) tuple: %s" % (addr,))
 
-    # Crear un nuevo hilo para manejar la solicitud del cliente
-    client_thread = threading.Thread(target=handle_client, args=(connectionSocket, addr))
-    client_thread.start()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-threaded web server.')
+    parser.add_argument('-p', type=int, default=9595,
+                        dest='port',
+                        help='port to listen on [int, default: %(default)s]')
+    parser.add_argument('-w', type=int, default=1,
+                        dest='workers',
+                        help=('number of pre-forked worker processes sharing '
+                              'the port [int, default: %(default)s]'))
+    parser.add_argument('-l', default='-',
+                        dest='access_log',
+                        help=('access log file, "-" for standard output '
+                              '[str, default: %(default)s]'))
+    main(parser.parse_args())
@@ -1,44 +1,344 @@
 from socket import *
-from time import time, ctime
+from time import ctime, perf_counter_ns, sleep, time, time_ns
+import argparse
+import heapq
+import os
+import selectors
 import sys
 
-# Checking to see if we have three arguments
-if (len(sys.argv) != 3):
-    print("Wrong number of arguments.")
-    print("Use: UDPPingClient.py <server_host> <server_port>")
-    sys.exit()
+from pingMonitor import MAX_ID_BYTES, MAX_INTERVAL_MS
+from pingStats import RttStats
 
-rtts = []
+# Python script for pinging the UDP server.
+# By default the pings are sent one after another, each waiting up to the
+# timeout for its reply. With -r the probes are pipelined: they are sent at
+# a fixed rate without waiting, and each reply is matched to its probe by
+# the sequence number and send timestamp it carries ("Ping <seq> <ns>"; the
+# server only changes the case of the letters). Times come from
+# perf_counter_ns(), which has sub-microsecond resolution. Statistics are
+# kept in constant memory (pingStats.py), so runs can be arbitrarily long.
+# Pipelined mode can probe several targets at once (-a): one socket per
+# address family is shared by all of them and replies are told apart by
+# their source address.
+# With -H the client only sends heartbeats, one every interval, until
+# stopped; the server tracks them (pingMonitor.py) and does not answer.
 
-# Preparing the socket
-serverHost, serverPort = sys.argv[1:]
-clientSocket = socket(AF_INET, SOCK_DGRAM)
-clientSocket.settimeout(1)
+# Sequence numbers remembered per target to tell duplicate replies from
+# late ones. Replies to outstanding probes are matched whatever their age.
+REPLY_WINDOW = 65536
 
-for i in range(10):
-    startTime = time() # Retrieve the current time
-    message = "Ping " + str(i+1) + " " + ctime(startTime)[11:19]
 
+class Target:
+    def __init__(self, name, sockaddr, sock):
+        self.name = name  # type: string, host:port as given
+        self.sockaddr = sockaddr  # type: address tuple to send to
+        self.sock = sock  # type: socket for its address family
+        self.stats = RttStats()
+        self.sent = 0
+        self.late = 0
+        self.duplicates = 0
+        self.answered = bytearray(REPLY_WINDOW)  # 1 if the seq in that slot was answered
+
+
+def drain(clientSocket):
+    # Discards the datagrams already waiting; returns how many
+    clientSocket.setblocking(False)
+    drained = 0
+    while True:
+        try:
+            clientSocket.recvfrom(1024)
+        except BlockingIOError:
+            return drained
+        except OSError:
+            continue  # e.g. ICMP port unreachable of an earlier ping
+        drained += 1
+
+
+def ping_sequential(clientSocket, address, count, timeoutSecs, stats):
+    # A reply is only taken for the current ping if it carries its sequence
+    # number ("PING <seq> <hh:mm:ss>"); late, duplicated or reordered replies
+    # to earlier pings are skipped. Returns how many were skipped.
+    stale = 0
+    for i in range(count):
+        stale += drain(clientSocket)
+        startTime = perf_counter_ns()  # Retrieve the current time
+        deadline = startTime + timeoutSecs * 1e9
+        message = "Ping " + str(i+1) + " " + ctime(time())[11:19]
+
+        try:
+            # Sending the message and waiting for its answer
+            clientSocket.sendto(message.encode(), address)
+            while True:
+                remaining = deadline - perf_counter_ns()
+                if remaining <= 0:
+                    raise timeout()
+                clientSocket.settimeout(remaining / 1e9)
+                encodedModified, serverAddress = clientSocket.recvfrom(1024)
+                parts = encodedModified.split()
+                if len(parts) >= 2 and parts[1] == str(i+1).encode():
+                    break
+                stale += 1
+
+            # Checking the current time and if the server answered
+            endTime = perf_counter_ns()
+            modifiedMessage = encodedModified.decode(errors='replace')
+            rtt = (endTime - startTime) / 1e6
+            stats.add_rtt(rtt)
+            print(modifiedMessage)
+            print("RTT: %.3f ms\n" % rtt)
+        except OSError:
+            stats.add_loss(i+1)
+            print("PING %i Request timed out\n" % (i+1))
+    return stale
+
+
+def parse_reply(data):
+    # "PING <seq> <ns>" -> (seq, ns), or None for anything else
+    parts = data.split()
+    if len(parts) != 3 or parts[0].upper() != b"PING" or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return int(parts[1]), int(parts[2])
+
+
+def make_targets(names):
+    # Resolves "host:port" names and opens one socket per address family.
+    # Returns the targets and a dict from reply source address to target.
+    # Replies are told apart by their source address only, so two names for
+    # the same address raise ValueError, as do names that cannot be resolved.
+    sockets = {}
+    targets = []
+    byAddress = {}
+    for name in names:
+        host, _, port = name.rpartition(':')
+        try:
+            family, _, _, _, sockaddr = getaddrinfo(host.strip('[]'), int(port), type=SOCK_DGRAM)[0]
+        except (OSError, ValueError, UnicodeError) as e:
+            raise ValueError("cannot resolve %s: %s" % (name, e))
+        if family not in sockets:
+            sockets[family] = socket(family, SOCK_DGRAM)
+            sockets[family].setblocking(False)
+        if sockaddr[:2] in byAddress:
+            raise ValueError("%s and %s are the same address (%s:%s)" % (
+                byAddress[sockaddr[:2]].name, name, sockaddr[0], sockaddr[1]))
+        target = Target(name, sockaddr, sockets[family])
+        targets.append(target)
+        byAddress[sockaddr[:2]] = target
+    return targets, byAddress
+
+
+def ping_pipelined(targets, byAddress, count, rate, timeoutSecs):
+    # Sends count probes to each target at `rate` per second (per target)
+    # and collects the replies as they come. A probe is lost if no reply
+    # arrives within timeoutSecs of sending it. Returns the seconds spent
+    # sending.
+    interval = 1e9 / rate
+    timeoutNs = int(timeoutSecs * 1e9)
+    outstanding = {}  # (target, seq) -> send time, in sending order
+    selector = selectors.DefaultSelector()
+    for sock in {target.sock for target in targets}:
+        selector.register(sock, selectors.EVENT_READ)
+
+    # Next probe of each target, as (due time, position, target). The
+    # targets' schedules are staggered over one interval.
+    start = lastSendTime = perf_counter_ns()
+    schedule = [(start + i * interval / len(targets), i, target) for i, target in enumerate(targets)]
+    heapq.heapify(schedule)
+
+    while schedule or outstanding:
+        # Send every probe that is due; after a slow iteration this sends
+        # several at once to keep the average rate
+        now = perf_counter_ns()
+        while schedule and schedule[0][0] <= now:
+            due, i, target = schedule[0]
+            sendTime = perf_counter_ns()
+            try:
+                target.sock.sendto(b"Ping %d %d" % (target.sent + 1, sendTime), target.sockaddr)
+            except BlockingIOError:
+                break  # socket buffer full, try again after reading
+            target.sent += 1
+            target.answered[target.sent % REPLY_WINDOW] = 0
+            outstanding[(target, target.sent)] = sendTime
+            lastSendTime = sendTime
+            if target.sent < count:
+                heapq.heapreplace(schedule, (due + interval, i, target))
+            else:
+                heapq.heappop(schedule)
+
+        # Probes without a reply after the timeout are lost
+        now = perf_counter_ns()
+        for (target, seq), sendTime in list(outstanding.items()):
+            if now - sendTime < timeoutNs:
+                break
+            del outstanding[(target, seq)]
+            target.stats.add_loss(seq)
+
+        # Wait for replies until the next probe is due or the oldest one
+        # times out
+        if schedule:
+            wakeUp = schedule[0][0]
+        elif outstanding:
+            wakeUp = next(iter(outstanding.values())) + timeoutNs
+        else:
+            break
+        for key, _ in selector.select(max(0, wakeUp - now) / 1e9):
+            receive_replies(key.fileobj, byAddress, outstanding)
+    selector.close()
+    return (lastSendTime - start) / 1e9
+
+
+def receive_replies(sock, byAddress, outstanding):
+    # Reads every datagram waiting on sock
+    while True:
+        try:
+            data, serverAddress = sock.recvfrom(1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            # e.g. ICMP port unreachable reported on a later read
+            continue
+        recvTime = perf_counter_ns()
+        target = byAddress.get(serverAddress[:2])
+        reply = parse_reply(data)
+        if target is None or reply is None:
+            continue
+        seq, sendTime = reply
+        inWindow = target.sent - REPLY_WINDOW < seq <= target.sent
+        if outstanding.get((target, seq)) == sendTime:
+            # The first reply to a probe still waiting for one
+            del outstanding[(target, seq)]
+            if inWindow:
+                target.answered[seq % REPLY_WINDOW] = 1
+            target.stats.add_rtt((recvTime - sendTime) / 1e6)
+        elif inWindow and (target, seq) not in outstanding:
+            # Its probe was answered already or timed out
+            slot = seq % REPLY_WINDOW
+            if target.answered[slot]:
+                target.duplicates += 1
+            else:
+                target.answered[slot] = 1
+                target.late += 1
+
+
+def report_targets(targets):
+    # One line per target, then the combined statistics
+    print("%-24s %8s %8s %9s %9s %9s %9s %6s" % (
+        "target", "sent", "lost %", "avg ms", "p50 ms", "p99 ms", "jitter", "late"))
+    combined = RttStats()
+    for target in targets:
+        stats = target.stats
+        print("%-24s %8i %8.1f %9.3f %9.3f %9.3f %9.3f %6i" % (
+            target.name, stats.sent, 100.0 * stats.lost / stats.sent if stats.sent else 0.0, stats.mean,
+            stats.percentile(50), stats.percentile(99), stats.jitter, target.late))
+        combined.merge(stats)
+    print(combined.report("Combined report (%i targets):" % len(targets)))
+
+
+def send_heartbeats(clientSocket, address, clientId, interval, count):
+    # Sends heartbeat number 1, 2, ... at start + k * interval (so delays in
+    # sending do not add up) until count are sent or Ctrl-C. Returns how
+    # many were sent.
+    intervalMs = int(round(interval * 1000))
+    start = perf_counter_ns()
+    sent = 0
     try:
-        # Sending the message and waiting for the answer
-        clientSocket.sendto(message.encode(),(serverHost, int(serverPort)))
-        encodedModified, serverAddress = clientSocket.recvfrom(1024)
-
-        # Checking the current time and if the server answered
-        endTime = time()
-        modifiedMessage = encodedModified.decode()
-        rtts += [((endTime - startTime)*1000)]
-        print(modifiedMessage)
-        print("RTT: %.3f ms\n" % rtts[-1])
-    except:
-        print("PING %i Request timed out\n" % (i+1))
-
-# Closing the socket
-clientSocket.close()
-
-# Reporting some stats
-print("UDP Pinger Report:")
-print("Maximum RTT: %.3f ms" % max(rtts))
-print("Minimum RTT: %.3f ms" % min(rtts))
-print("Average RTT: %.3f ms" % (sum(rtts)/len(rtts)))
-print("Package loss rate: %i%%" % ((10-len(rtts))*10))
+        while count is None or sent < count:
+            wait = start + sent * interval * 1e9 - perf_counter_ns()
+            if wait > 0:
+                sleep(wait / 1e9)
+            try:
+                clientSocket.sendto(b"Heartbeat %s %d %d %d" % (clientId.encode(), sent + 1, time_ns(), intervalMs),
+                                    address)
+            except OSError as e:
+                print("Heartbeat %i not sent: %s" % (sent + 1, e))
+            sent += 1
+    except KeyboardInterrupt:
+        pass
+    return sent
+
+
+def main(options):
+    if options.heartbeat > 0:
+        clientSocket = socket(AF_INET, SOCK_DGRAM)
+        # The default id is cut to fit the server's limit
+        pid = '-%d' % os.getpid()
+        clientId = options.client_id or gethostname()[:MAX_ID_BYTES - len(pid)] + pid
+        print("Sending heartbeats as %s every %.3f s" % (clientId, options.heartbeat))
+        sent = send_heartbeats(clientSocket, (options.server_host, options.server_port), clientId,
+                               options.heartbeat, options.count)
+        clientSocket.close()
+        print("Sent %i heartbeats" % sent)
+        return
+
+    if options.count is None:
+        options.count = 10
+    if options.rate > 0:
+        names = ['%s:%s' % (options.server_host, options.server_port)] + options.targets
+        try:
+            targets, byAddress = make_targets(names)
+        except ValueError as e:
+            sys.exit("UDPPingerClient.py: error: %s" % e)
+        elapsed = ping_pipelined(targets, byAddress, options.count, options.rate, options.timeout)
+        sent = sum(target.sent for target in targets)
+        print("Sent %i probes in %.3f s (%.0f/s), %i late and %i duplicate replies"
+              % (sent, elapsed, (sent - 1) / elapsed if elapsed else 0.0,
+                 sum(target.late for target in targets), sum(target.duplicates for target in targets)))
+        for sock in {target.sock for target in targets}:
+            sock.close()
+        if len(targets) == 1:
+            print(targets[0].stats.report())
+        else:
+            report_targets(targets)
+        return
+
+    # Preparing the socket
+    clientSocket = socket(AF_INET, SOCK_DGRAM)
+    stats = RttStats()
+    stale = ping_sequential(clientSocket, (options.server_host, options.server_port), options.count,
+                            options.timeout, stats)
+
+    # Closing the socket
+    clientSocket.close()
+
+    # Reporting some stats
+    if stale:
+        print("Skipped %i late or duplicate replies" % stale)
+    print(stats.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UDP pinger client.',
+                                     usage='python UDPPingerClient.py <server_host> <server_port> [options]')
+    parser.add_argument('server_host',
+                        help='host of the UDP pinger server')
+    parser.add_argument('server_port', type=int,
+                        help='port of the UDP pinger server')
+    parser.add_argument('-a', action='append', default=[],
+                        dest='targets', metavar='HOST:PORT',
+                        help='another server to probe at the same time, can be repeated (needs -r)')
+    parser.add_argument('-c', type=int, default=None,
+                        dest='count',
+                        help=('number of pings to send (to each server) '
+                              '[int, default: 10, unlimited with -H]'))
+    parser.add_argument('-H', type=float, default=0,
+                        dest='heartbeat', metavar='INTERVAL',
+                        help='only send a heartbeat every INTERVAL seconds, until Ctrl-C [float]')
+    parser.add_argument('-i', default=None,
+                        dest='client_id',
+                        help='client id sent in heartbeats [default: <hostname>-<pid>]')
+    parser.add_argument('-r', type=float, default=0,
+                        dest='rate',
+                        help=('send this many probes per second (to each server) without waiting for '
+                              'the replies, 0 to send one ping at a time [float, default: %(default)s]'))
+    parser.add_argument('-t', type=float, default=1.0,
+                        dest='timeout',
+                        help='seconds to wait for a reply [float, default: %(default)s]')
+    options = parser.parse_args()
+    if options.targets and options.rate <= 0:
+        parser.error("-a needs a probe rate (-r)")
+    if options.client_id is not None and (not options.client_id or len(options.client_id.split()) != 1):
+        parser.error("the client id cannot be empty or contain spaces")
+    if options.client_id is not None and len(options.client_id.encode()) > MAX_ID_BYTES:
+        parser.error("the client id cannot be longer than %d bytes" % MAX_ID_BYTES)
+    if options.heartbeat < 0 or (options.heartbeat and not 1 <= round(options.heartbeat * 1000) <= MAX_INTERVAL_MS):
+        parser.error("the heartbeat interval must be between 0.001 and %d seconds" % (MAX_INTERVAL_MS // 1000))
+    main(options)
@@ -1,23 +1,235 @@
 # UDPPingerServer.py
 # We will need the following module to generate randomized lost packets
+import argparse
+import heapq
+import os
 import random
+import select
+import signal
+import sys
+import time
 from socket import *
 
-# Create a UDP socket
-# Notice the use of SOCK_DGRAM for UDP packets
-serverSocket = socket(AF_INET, SOCK_DGRAM)
-# Assign IP address and port number to socket
-serverSocket.bind(('', 9696))
-
-while True:
-	# Generate random number in the range of 0 to 10
-	rand = random.randint(0, 10)
-	# Receive the client packet along with the address it is coming from
-	message, address = serverSocket.recvfrom(1024)
-	# Capitalize the message from the client
-	message = message.upper()
-	# If rand is less is than 4, we consider the packet lost and do not respond
-	if rand < 4:
-		continue
-	# Otherwise, the server responds
-	serverSocket.sendto(message, address)
+from pingImpair import DELAYS, Impairment
+from pingMonitor import HeartbeatMonitor
+
+# By default a packet is lost with the same probability as randint(0, 10) < 4
+DEFAULT_LOSS = 4 / 11
+
+
+def create_server_socket(serverPort, reusePort=False):
+	# Create a UDP socket
+	# Notice the use of SOCK_DGRAM for UDP packets
+	serverSocket = socket(AF_INET, SOCK_DGRAM)
+	# With reusePort several processes can bind the same port and the
+	# kernel spreads the incoming datagrams among them (by source address,
+	# so one client socket is always served by the same worker)
+	if reusePort:
+		serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+	# Assign IP address and port number to socket
+	serverSocket.bind(('', serverPort))
+	serverSocket.setblocking(False)
+	return serverSocket
+
+
+def send_reply(serverSocket, message, address, counters):
+	try:
+		serverSocket.sendto(message, address)
+	except OSError:
+		# Send buffer full: the reply is lost as well
+		counters['dropped'] += 1
+
+
+def serve(serverSocket, impairment, monitor, batchSize, counters):
+	# Python has no recvmmsg(), so batches are read with a loop: wait until
+	# the socket is readable, then take up to batchSize datagrams without
+	# blocking before answering them. Delayed replies wait in a heap of
+	# (due time, order, message, address) and are sent when due.
+	pending = []
+	order = 0
+	while True:
+		# Wake up for the next delayed reply or heartbeat export
+		wakeUp = min(pending[0][0], monitor.nextExport) if pending else monitor.nextExport
+		select.select([serverSocket], [], [], max(0.0, wakeUp - time.monotonic()))
+		batch = []
+		while len(batch) < batchSize:
+			try:
+				batch.append(serverSocket.recvfrom(1024))
+			except BlockingIOError:
+				break
+			except OSError:
+				continue
+		counters['received'] += len(batch)
+		now = time.monotonic()
+		for message, address in batch:
+			if message.startswith(b"Heartbeat "):
+				# Heartbeats are not answered, so only loss applies to them
+				if impairment.is_lost():
+					impairment.lost += 1
+				else:
+					monitor.record(message, address)
+				continue
+			# The impairment decides whether the packet is lost (no replies)
+			# and otherwise when to respond with the message capitalized
+			for delay in impairment.plan():
+				if delay <= 0:
+					send_reply(serverSocket, message.upper(), address, counters)
+				else:
+					order += 1
+					heapq.heappush(pending, (now + delay, order, message.upper(), address))
+
+		now = time.monotonic()
+		while pending and pending[0][0] <= now:
+			_, _, message, address = heapq.heappop(pending)
+			send_reply(serverSocket, message, address, counters)
+		monitor.tick()
+
+
+def run_worker(serverSocket, serverPort, workerId, options):
+	# Each worker has its own random generator, seeded from -s if given
+	seed = options.seed + workerId if options.seed is not None else None
+	impairment = make_impairment(random.Random(seed), options)
+	monitor = HeartbeatMonitor(export_path(options.export, workerId, options.workers), options.export_interval)
+	counters = {'received': 0, 'dropped': 0}
+	if serverSocket is None:
+		serverSocket = create_server_socket(serverPort, reusePort=True)
+	if workerId == 0:
+		print("Impairments: " + impairment.describe())
+	print("Worker %d (pid %d) ready to serve . . ." % (workerId, os.getpid()))
+	try:
+		serve(serverSocket, impairment, monitor, options.batch, counters)
+	except (KeyboardInterrupt, SystemExit):
+		pass
+	finally:
+		monitor.close()
+		if monitor.clients:
+			print(monitor.report())
+		print("Worker %d: %d packets received, %d lost, %d duplicated, %d reordered, %d delayed, %d send errors" % (
+			workerId, counters['received'], impairment.lost, impairment.duplicated, impairment.reordered,
+			impairment.delayed, counters['dropped']))
+
+
+def export_path(path, workerId, workers):
+	# Each worker writes its own file: name.csv -> name.<worker>.csv
+	if path is None or workers <= 1:
+		return path
+	stem, dot, extension = path.rpartition('.')
+	if not dot or '/' in extension:
+		return '%s.%d' % (path, workerId)
+	return '%s.%d.%s' % (stem, workerId, extension)
+
+
+def make_impairment(rng, options):
+	return Impairment(rng, loss=options.loss, burst=options.burst, delay=options.delay / 1000.0,
+					  jitter=options.jitter / 1000.0, distribution=options.distribution,
+					  duplicate=options.duplicate, reorder=options.reorder,
+					  reorderGap=options.reorder_gap / 1000.0)
+
+
+def parse_burst(text):
+	# "P,R[,BAD_LOSS]" -> (p, r, badLoss)
+	values = [float(value) for value in text.split(',')]
+	if len(values) not in (2, 3) or not all(0.0 <= value <= 1.0 for value in values):
+		raise argparse.ArgumentTypeError("expected P,R[,BAD_LOSS] with probabilities in [0, 1]")
+	if len(values) == 2:
+		values.append(1.0)
+	return tuple(values)
+
+
+def run_workers(serverPort, options):
+	# Starts the worker processes and stops them on SIGINT/SIGTERM
+	serverSocket = None
+	if 'SO_REUSEPORT' not in globals():
+		# Without SO_REUSEPORT the workers share one inherited socket
+		serverSocket = create_server_socket(serverPort)
+
+	workers = []
+	for workerId in range(options.workers):
+		pid = os.fork()
+		if pid == 0:
+			signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+			signal.signal(signal.SIGINT, signal.SIG_IGN)
+			try:
+				run_worker(serverSocket, serverPort, workerId, options)
+			finally:
+				os._exit(0)
+		workers.append(pid)
+
+	def stop(signum, frame):
+		for pid in workers:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	for pid in workers:
+		while True:
+			try:
+				os.waitpid(pid, 0)
+				break
+			except InterruptedError:
+				continue
+			except ChildProcessError:
+				break
+
+
+def main(options):
+	if options.workers > 1 and hasattr(os, 'fork'):
+		run_workers(options.port, options)
+		return
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	serverSocket = create_server_socket(options.port)
+	run_worker(serverSocket, options.port, 0, options)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='UDP pinger server.')
+	parser.add_argument('-p', type=int, default=9696,
+						dest='port',
+						help='port to listen on [int, default: %(default)s]')
+	parser.add_argument('-w', type=int, default=1,
+						dest='workers',
+						help=('number of worker processes sharing the port with SO_REUSEPORT '
+							  '[int, default: %(default)s]'))
+	parser.add_argument('-b', type=int, default=64,
+						dest='batch',
+						help='datagrams read per batch [int, default: %(default)s]')
+	parser.add_argument('-l', type=float, default=DEFAULT_LOSS,
+						dest='loss',
+						help=('probability of dropping a packet (in the good state with -g) '
+							  '[float, default: 4/11]'))
+	parser.add_argument('-g', type=parse_burst, default=None,
+						dest='burst', metavar='P,R[,BAD_LOSS]',
+						help=('bursty Gilbert-Elliott loss: probability of going to the bad state, of '
+							  'leaving it, and of a loss while in it [default: 1.0]'))
+	parser.add_argument('-d', type=float, default=0.0,
+						dest='delay',
+						help='milliseconds to delay each reply [float, default: %(default)s]')
+	parser.add_argument('-j', type=float, default=0.0,
+						dest='jitter',
+						help='jitter added to the delay, in milliseconds [float, default: %(default)s]')
+	parser.add_argument('-J', default='uniform', choices=sorted(DELAYS),
+						dest='distribution',
+						help='distribution of the jitter [default: %(default)s]')
+	parser.add_argument('-u', type=float, default=0.0,
+						dest='duplicate',
+						help='probability of sending a reply twice [float, default: %(default)s]')
+	parser.add_argument('-o', type=float, default=0.0,
+						dest='reorder',
+						help='probability of holding a reply back so later ones overtake it [float, default: %(default)s]')
+	parser.add_argument('-O', type=float, default=10.0,
+						dest='reorder_gap',
+						help='milliseconds a reordered reply is held back [float, default: %(default)s]')
+	parser.add_argument('-s', type=int, default=None,
+						dest='seed',
+						help='random seed; worker i uses seed + i [int, default: random]')
+	parser.add_argument('-m', default=None,
+						dest='export', metavar='FILE',
+						help=('append per client heartbeat statistics to FILE, as CSV if it ends in .csv '
+							  'and binary records otherwise (one file per worker)'))
+	parser.add_argument('-e', type=float, default=10.0,
+						dest='export_interval',
+						help='seconds between heartbeat exports [float, default: %(default)s]')
+	main(parser.parse_args())
@@ -0,0 +1,105 @@
+# Network impairments for the UDP pinger server.
+#
+# Every received ping goes through Impairment.plan(), which decides how many
+# replies it gets (none if lost, two if duplicated) and how long each one is
+# held back. The server keeps the held back replies in a heap ordered by
+# due time, so delays never block the receive loop.
+# - loss: independent with probability `loss`, or bursty with the
+#   Gilbert-Elliott model: a two state Markov chain that goes from the good
+#   to the bad state with probability p and back with probability r, and
+#   loses packets with probability `loss` in the good state and `badLoss`
+#   in the bad one. Mean burst length is about 1/r.
+# - delay: a base delay plus jitter drawn from a distribution (see DELAYS).
+#   Delays are never negative.
+# - duplication: with probability `duplicate` a second copy is sent, with
+#   its own delay.
+# - reordering: with probability `reorder` a reply is held back an extra
+#   `reorderGap` seconds, so the ones after it overtake it.
+
+import math
+
+# Jitter distributions: function(rng, jitter) -> seconds added to the base
+# delay
+DELAYS = {
+    'uniform': lambda rng, jitter: rng.uniform(-jitter, jitter),
+    'normal': lambda rng, jitter: rng.gauss(0.0, jitter),
+    # Long tailed: mostly small, sometimes several times the jitter
+    'exponential': lambda rng, jitter: rng.expovariate(1.0 / jitter) if jitter else 0.0,
+    'pareto': lambda rng, jitter: jitter * (rng.paretovariate(2.0) - 1.0),
+}
+
+
+class Impairment:
+    def __init__(self, rng, loss=0.0, burst=None, delay=0.0, jitter=0.0, distribution='uniform',
+                 duplicate=0.0, reorder=0.0, reorderGap=0.01):
+        self.rng = rng  # type: random.Random
+        self.loss = loss  # type: float, loss probability (in the good state)
+        # Gilbert-Elliott (p, r, badLoss), or None for independent losses
+        self.burst = burst  # type: tuple
+        self.delay = delay  # type: float, seconds
+        self.jitter = jitter  # type: float, seconds
+        self.distribution = distribution
+        self.sample = DELAYS[distribution]
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorderGap = reorderGap  # type: float, seconds
+
+        # State.
+        self.bad = False  # Gilbert-Elliott state
+        self.lost = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.delayed = 0
+
+    def is_lost(self):
+        rng = self.rng
+        if self.burst is None:
+            return rng.random() < self.loss
+        p, r, badLoss = self.burst
+        if self.bad:
+            self.bad = rng.random() >= r
+        else:
+            self.bad = rng.random() < p
+        return rng.random() < (badLoss if self.bad else self.loss)
+
+    def delay_of(self):
+        # Seconds to hold back one reply
+        delay = self.delay
+        if self.jitter:
+            delay += self.sample(self.rng, self.jitter)
+        if self.reorder and self.rng.random() < self.reorder:
+            self.reordered += 1
+            delay += self.reorderGap
+        return max(0.0, delay)
+
+    def plan(self):
+        # Delays (seconds) of the replies to one ping; empty if it is lost
+        if self.is_lost():
+            self.lost += 1
+            return []
+        delays = [self.delay_of()]
+        if self.duplicate and self.rng.random() < self.duplicate:
+            self.duplicated += 1
+            delays.append(self.delay_of())
+        self.delayed += sum(1 for delay in delays if delay > 0)
+        return delays
+
+    def describe(self):
+        # One line summary of the settings
+        if self.burst is None:
+            parts = ["loss %.1f%%" % (100.0 * self.loss)]
+        else:
+            p, r, badLoss = self.burst
+            # Share of time in the bad state, in the chain's steady state
+            badShare = p / (p + r) if p + r else 0.0
+            parts = ["burst loss p=%g r=%g (good %.1f%%, bad %.1f%%, ~%.1f%% overall, mean burst %.1f)" % (
+                p, r, 100.0 * self.loss, 100.0 * badLoss,
+                100.0 * (badShare * badLoss + (1 - badShare) * self.loss), 1.0 / r if r else math.inf)]
+        if self.delay or self.jitter:
+            parts.append("delay %.1f ms +- %.1f ms %s" % (1000 * self.delay, 1000 * self.jitter,
+                                                          self.distribution))
+        if self.duplicate:
+            parts.append("duplicate %.1f%%" % (100.0 * self.duplicate))
+        if self.reorder:
+            parts.append("reorder %.1f%% by %.1f ms" % (100.0 * self.reorder, 1000 * self.reorderGap))
+        return ", ".join(parts)
@@ -0,0 +1,320 @@
+# Heartbeat monitoring for the UDP pinger server.
+#
+# In heartbeat mode a client sends "Heartbeat <id> <seq> <ns> <interval ms>"
+# every interval, where ns is its wall clock time (time.time_ns()). The
+# server does not answer them; it keeps per client:
+# - when it was last seen, and the gaps: sequence numbers that never
+#   arrived, heartbeats that came late (out of order or duplicated), and
+#   silences longer than SILENCE_INTERVALS intervals. The last SEQ_WINDOW
+#   sequence numbers are remembered, so a late heartbeat that fills a gap
+#   is no longer counted as lost. Counting starts at the first heartbeat
+#   seen; earlier ones arriving after it are ignored. A client restart
+#   (sequence back, send time forward) starts counting again,
+# - the one-way delay (arrival minus send time). Client and server clocks
+#   are not synchronized, so the raw value includes the clock offset; the
+#   smallest one seen is taken as offset plus base delay, and the delay
+#   above it is the queueing/jitter estimate,
+# - the last RING_SIZE samples in a ring buffer of fixed size arrays.
+# Every export interval one row per client is appended to the export file:
+# CSV if its name ends in .csv, otherwise fixed size binary records
+# (RECORD). Rows are only built and written once per interval, so the cost
+# per heartbeat is a few additions. Heartbeats are not authenticated, so
+# their fields are range checked and an export error is only printed: a
+# bad datagram must not stop the server, and at most MAX_CLIENTS clients
+# are tracked: when full, a new client replaces the longest silent one that
+# is down, or its heartbeats are dropped.
+
+from array import array
+import csv
+import math
+import struct
+import time
+
+RING_SIZE = 256
+
+# Sequence numbers remembered per client to tell a filled gap from a
+# duplicate
+SEQ_WINDOW = 1024
+
+# Accepted heartbeat fields: sequence numbers fit the unsigned 32 bit
+# columns, send times are 64 bit nanoseconds, intervals are 1 ms to 1 hour
+MAX_SEQ = 0xffffffff
+MAX_NS = 2 ** 63 - 1
+MAX_INTERVAL_MS = 3600 * 1000
+MAX_ID_BYTES = 32
+
+# Clients tracked at once (each takes about 5 KB)
+MAX_CLIENTS = 1024
+
+# A heartbeat is "silent" after this many intervals without one
+SILENCE_INTERVALS = 3
+
+COLUMNS = ('time', 'client', 'received', 'lost', 'late', 'silences', 'last_seen_ago',
+           'min_owd_ms', 'mean_extra_ms', 'max_extra_ms')
+
+# Binary rows: window end (unix seconds), client id (utf-8, padded), then
+# the other columns in order
+RECORD = struct.Struct('<d32sIIIIffff')
+
+
+def parse_heartbeat(data):
+    # "Heartbeat <id> <seq> <ns> <interval ms>" -> (id, seq, ns, interval
+    # in seconds), or None for anything else or out of range
+    parts = data.split()
+    if (len(parts) != 5 or parts[0] != b"Heartbeat" or len(parts[1]) > MAX_ID_BYTES
+            or not all(part.isdigit() for part in parts[2:])):
+        return None
+    try:
+        clientId = parts[1].decode()
+    except UnicodeDecodeError:
+        return None
+    seq, sendNs, intervalMs = int(parts[2]), int(parts[3]), int(parts[4])
+    if not (1 <= seq <= MAX_SEQ and sendNs <= MAX_NS and 1 <= intervalMs <= MAX_INTERVAL_MS):
+        return None
+    return clientId, seq, sendNs, intervalMs / 1000.0
+
+
+class ClientTrack:
+    def __init__(self, clientId, address):
+        self.clientId = clientId  # type: string
+        self.address = address  # type: address tuple of the last heartbeat
+        self.interval = 0.0  # seconds, as announced by the client
+        self.lastSeen = 0.0  # monotonic time of the last heartbeat
+        self.firstSeq = 0  # heartbeats before it are ignored
+        self.lastSeq = 0
+        self.lastSendNs = 0  # send time of lastSeq
+        self.minDelay = math.inf  # ms, offset plus base delay
+        self.down = False
+        self.seen = bytearray(SEQ_WINDOW)  # 1 if the seq in that slot arrived
+
+        # Totals.
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.silences = 0
+
+        # Current export window.
+        self.windowReceived = 0
+        self.windowLost = 0
+        self.windowLate = 0
+        self.windowSilences = 0
+        self.windowDelaySum = 0.0  # ms, raw one-way delays
+        self.windowDelayMax = -math.inf
+
+        # Ring of the last RING_SIZE samples.
+        self.ringSeq = array('I', bytes(4 * RING_SIZE))
+        self.ringArrival = array('d', bytes(8 * RING_SIZE))  # unix seconds
+        self.ringDelay = array('f', bytes(4 * RING_SIZE))  # raw one-way delay, ms
+        self.ringNext = 0  # total samples written
+
+    def add(self, seq, sendNs, arrivalNs, now):
+        # sendNs and arrivalNs in unix nanoseconds, now in monotonic seconds.
+        # Returns False if the heartbeat is ignored.
+        slot = seq % SEQ_WINDOW
+        if not self.received or (seq < self.lastSeq and sendNs > self.lastSendNs):
+            # First heartbeat seen, or the client restarted: the sequence
+            # went back but the send time went forward, which a late or
+            # duplicated heartbeat cannot do. Nothing before it is lost.
+            self.seen[:] = bytes(SEQ_WINDOW)
+            self.firstSeq = self.lastSeq = seq
+            self.lastSendNs = sendNs
+        elif seq < self.firstSeq:
+            return False
+        elif seq <= self.lastSeq - SEQ_WINDOW:
+            # Too old to tell a filled gap from a duplicate
+            self.late += 1
+            self.windowLate += 1
+        elif seq > self.lastSeq:
+            missing = seq - self.lastSeq - 1
+            self.lost += missing
+            self.windowLost += missing
+            if missing >= SEQ_WINDOW:
+                self.seen[:] = bytes(SEQ_WINDOW)
+            else:
+                for skipped in range(self.lastSeq + 1, seq):
+                    self.seen[skipped % SEQ_WINDOW] = 0
+            self.lastSeq = seq
+            self.lastSendNs = sendNs
+        else:
+            self.late += 1
+            self.windowLate += 1
+            if not self.seen[slot]:
+                # Fills a gap counted as lost when it was skipped (in this
+                # window or an earlier one); a duplicate is only late
+                self.lost -= 1
+                self.windowLost = max(0, self.windowLost - 1)
+        if seq > self.lastSeq - SEQ_WINDOW:
+            self.seen[slot] = 1
+        delay = (arrivalNs - sendNs) / 1e6
+        if self.received and self.interval and now - self.lastSeen > SILENCE_INTERVALS * self.interval:
+            self.silences += 1
+            self.windowSilences += 1
+        self.received += 1
+        self.windowReceived += 1
+        self.lastSeen = now
+        self.down = False
+        self.minDelay = min(self.minDelay, delay)
+        self.windowDelaySum += delay
+        self.windowDelayMax = max(self.windowDelayMax, delay)
+
+        ring = self.ringNext % RING_SIZE
+        self.ringSeq[ring] = seq
+        self.ringArrival[ring] = arrivalNs / 1e9
+        self.ringDelay[ring] = delay
+        self.ringNext += 1
+        return True
+
+    def recent_delays(self):
+        # Raw one-way delays (ms) in the ring, oldest first
+        count = min(self.ringNext, RING_SIZE)
+        start = self.ringNext - count
+        return [self.ringDelay[i % RING_SIZE] for i in range(start, self.ringNext)]
+
+    def take_window(self, now, wallTime):
+        # The row for this export window, then starts a new window
+        if self.windowReceived:
+            meanExtra = self.windowDelaySum / self.windowReceived - self.minDelay
+            maxExtra = self.windowDelayMax - self.minDelay
+        else:
+            meanExtra = maxExtra = 0.0
+        row = (wallTime, self.clientId, self.windowReceived, self.windowLost, self.windowLate,
+               self.windowSilences, now - self.lastSeen, self.minDelay, meanExtra, maxExtra)
+        self.windowReceived = self.windowLost = self.windowLate = self.windowSilences = 0
+        self.windowDelaySum = 0.0
+        self.windowDelayMax = -math.inf
+        return row
+
+
+class HeartbeatMonitor:
+    def __init__(self, exportPath=None, exportInterval=10.0):
+        self.exportInterval = exportInterval  # type: float, seconds
+        self.clients = {}  # client id -> ClientTrack
+        self.nextExport = time.monotonic() + exportInterval
+        self.rows = 0
+        self.dropped = 0  # heartbeats of new clients while full
+        self._file = None
+        self._writer = None
+        if exportPath is not None:
+            if exportPath.endswith('.csv'):
+                self._file = open(exportPath, 'a', newline='')
+                self._writer = csv.writer(self._file)
+                if self._file.tell() == 0:
+                    self._writer.writerow(COLUMNS)
+            else:
+                self._file = open(exportPath, 'ab')
+
+    def record(self, data, address):
+        # Handles a heartbeat datagram; returns False if data is not one
+        heartbeat = parse_heartbeat(data)
+        if heartbeat is None:
+            return False
+        clientId, seq, sendNs, interval = heartbeat
+        arrivalNs = time.time_ns()
+        client = self.clients.get(clientId)
+        if client is None:
+            if len(self.clients) >= MAX_CLIENTS and not self.evict():
+                self.dropped += 1
+                return True
+            client = self.clients[clientId] = ClientTrack(clientId, address)
+            print("Heartbeat: new client %s from %s:%d" % (clientId, address[0], address[1]))
+        now = time.monotonic()
+        silentFor = now - client.lastSeen
+        wasDown = client.down
+        if client.add(seq, sendNs, arrivalNs, now):
+            client.address = address
+            client.interval = interval
+            if wasDown:
+                print("Heartbeat: client %s is back after %.1f s" % (clientId, silentFor))
+        return True
+
+    def evict(self):
+        # Forgets the longest silent client that is down; False if none is.
+        # Its last row was exported when it went down.
+        down = [client for client in self.clients.values() if client.down]
+        if not down:
+            return False
+        del self.clients[min(down, key=lambda client: client.lastSeen).clientId]
+        return True
+
+    def tick(self):
+        # Called by the server loop; exports a window when it is due
+        now = time.monotonic()
+        if now < self.nextExport:
+            return
+        self.nextExport = now + self.exportInterval
+        wallTime = time.time()
+        rows = []
+        for client in self.clients.values():
+            if client.down:
+                continue
+            if client.interval and now - client.lastSeen > SILENCE_INTERVALS * client.interval:
+                client.down = True
+                print("Heartbeat: client %s silent for %.1f s" % (client.clientId, now - client.lastSeen))
+            rows.append(client.take_window(now, wallTime))
+        self.write(rows)
+
+    def write(self, rows):
+        if self._file is None or not rows:
+            return
+        try:
+            if self._writer is not None:
+                self._writer.writerows((row[0], row[1]) + row[2:6] + tuple('%.3f' % value for value in row[6:])
+                                       for row in rows)
+            else:
+                self._file.write(b''.join(pack_record(row) for row in rows))
+            self._file.flush()
+        except (OSError, ValueError, struct.error) as e:
+            # Keep serving; the rows of this window are lost
+            print("Heartbeat export failed: %s" % e)
+            return
+        self.rows += len(rows)
+
+    def close(self):
+        # Exports the last, partial window
+        self.nextExport = 0.0
+        self.tick()
+        if self._file is not None:
+            self._file.close()
+
+    def report(self):
+        lines = ["Heartbeat clients: %d (%d rows exported)" % (len(self.clients), self.rows)]
+        if self.dropped:
+            lines.append("Dropped %d heartbeats of new clients (limit of %d clients)" % (self.dropped, MAX_CLIENTS))
+        for client in self.clients.values():
+            delays = sorted(client.recent_delays())
+            extra = delays[len(delays) // 2] - client.minDelay if delays else 0.0
+            lines.append("%s: %d received, %d lost, %d late, %d silences, median extra delay %.3f ms (last %d)" % (
+                client.clientId, client.received, client.lost, client.late, client.silences, extra, len(delays)))
+        return "\n".join(lines)
+
+
+def pack_record(row):
+    # Counters are clamped to the unsigned 32 bit columns and delays to
+    # what a float32 holds; a long id is cut on a character boundary
+    counts = [min(max(value, 0), 0xffffffff) for value in row[2:6]]
+    floats = [min(max(value, -3e38), 3e38) for value in row[6:]]
+    clientId = row[1].encode()[:MAX_ID_BYTES].decode(errors='ignore').encode()
+    return RECORD.pack(row[0], clientId, *(counts + floats))
+
+
+def read_records(path):
+    # Yields the rows of a binary export file as tuples in COLUMNS order
+    with open(path, 'rb') as recordFile:
+        while True:
+            data = recordFile.read(RECORD.size)
+            if len(data) < RECORD.size:
+                return
+            row = RECORD.unpack(data)
+            yield (row[0], row[1].rstrip(b'\0').decode(errors='replace')) + row[2:]
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Prints a binary heartbeat export file as CSV.')
+    parser.add_argument('path',
+                        help='file written by UDPPingerServer.py -m')
+    options = parser.parse_args()
+    writer = csv.writer(sys.stdout)
+    writer.writerow(COLUMNS)
+    writer.writerows(row[:6] + tuple('%.3f' % value for value in row[6:]) for row in read_records(options.path))
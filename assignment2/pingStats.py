@@ -0,0 +1,145 @@
+# Streaming RTT statistics for the UDP pinger.
+#
+# Everything is updated one probe at a time in constant memory, so a ping
+# run can last for millions of probes:
+# - mean and variance with Welford's online algorithm,
+# - interarrival jitter as in RFC 3550 (section 6.4.1): a running average,
+#   with gain 1/16, of the difference between consecutive RTTs,
+# - percentiles from a log-linear (HDR-style) histogram of the RTTs in
+#   microseconds: values below 2 * SUB_BUCKETS are exact and larger ones
+#   fall in buckets at most 1/SUB_BUCKETS of their value wide,
+# - loss bursts (runs of consecutive lost sequence numbers), as a count of
+#   bursts per length.
+
+from collections import Counter
+import math
+
+SUB_BUCKETS = 64  # about 1.5% relative precision
+
+
+def bucket_index(value):
+    # Histogram bucket of a non-negative integer value
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKETS.bit_length()
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_range(index):
+    # Smallest and largest value of a bucket
+    if index < 2 * SUB_BUCKETS:
+        return index, index
+    shift = index // SUB_BUCKETS - 1
+    low = (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+    return low, low + (1 << shift) - 1
+
+
+class RttStats:
+    def __init__(self):
+        self.received = 0
+        self.lost = 0
+        self.mean = 0.0  # ms
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.minimum = math.inf
+        self.maximum = 0.0
+        self.jitter = 0.0  # ms
+        self.lastRtt = None
+        self.histogram = []  # bucket index -> count, RTTs in microseconds
+        self.bursts = Counter()  # burst length -> number of bursts
+        self.lastLost = None  # sequence number of the last lost probe
+        self.burstLength = 0
+
+    def add_rtt(self, rtt):
+        # rtt in ms
+        self.received += 1
+        delta = rtt - self.mean
+        self.mean += delta / self.received
+        self.m2 += delta * (rtt - self.mean)
+        self.minimum = min(self.minimum, rtt)
+        self.maximum = max(self.maximum, rtt)
+        if self.lastRtt is not None:
+            self.jitter += (abs(rtt - self.lastRtt) - self.jitter) / 16
+        self.lastRtt = rtt
+        index = bucket_index(int(rtt * 1000))
+        if index >= len(self.histogram):
+            self.histogram.extend([0] * (index + 1 - len(self.histogram)))
+        self.histogram[index] += 1
+
+    def add_loss(self, seq):
+        # Losses must be reported in increasing sequence order
+        self.lost += 1
+        if self.lastLost is not None and seq == self.lastLost + 1:
+            self.burstLength += 1
+        else:
+            if self.burstLength:
+                self.bursts[self.burstLength] += 1
+            self.burstLength = 1
+        self.lastLost = seq
+
+    def merge(self, other):
+        # Adds the probes of another RttStats (e.g. of another target).
+        # Jitter becomes the average of both, weighted by their replies.
+        if other.received:
+            total = self.received + other.received
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.received * other.received / total
+            self.mean += delta * other.received / total
+            self.jitter = (self.jitter * self.received + other.jitter * other.received) / total
+            self.received = total
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+            if len(other.histogram) > len(self.histogram):
+                self.histogram.extend([0] * (len(other.histogram) - len(self.histogram)))
+            for index, count in enumerate(other.histogram):
+                self.histogram[index] += count
+        self.lost += other.lost
+        self.bursts.update(other.loss_bursts())
+
+    @property
+    def sent(self):
+        return self.received + self.lost
+
+    def variance(self):
+        return self.m2 / (self.received - 1) if self.received > 1 else 0.0
+
+    def percentile(self, p):
+        # RTT (ms) below which p% of the replies fall, to the precision of
+        # the histogram
+        if not self.received:
+            return 0.0
+        rank = max(1, int(math.ceil(p / 100.0 * self.received)))
+        cumulative = 0
+        for index, count in enumerate(self.histogram):
+            cumulative += count
+            if cumulative >= rank:
+                low, high = bucket_range(index)
+                # Middle of the bucket, but never outside the values seen
+                return min(max((low + high) / 2000.0, self.minimum), self.maximum)
+        return self.maximum
+
+    def loss_bursts(self):
+        # Counter of burst lengths, including the burst still open
+        bursts = Counter(self.bursts)
+        if self.burstLength:
+            bursts[self.burstLength] += 1
+        return bursts
+
+    def report(self, title="UDP Pinger Report:"):
+        lines = [title]
+        if self.received:
+            lines.append("Maximum RTT: %.3f ms" % self.maximum)
+            lines.append("Minimum RTT: %.3f ms" % self.minimum)
+            lines.append("Average RTT: %.3f ms (stddev %.3f ms)" % (self.mean, math.sqrt(self.variance())))
+            lines.append("Jitter:      %.3f ms" % self.jitter)
+            lines.append("Percentiles: p50 %.3f  p90 %.3f  p99 %.3f  p99.9 %.3f ms" % (
+                self.percentile(50), self.percentile(90), self.percentile(99), self.percentile(99.9)))
+        else:
+            lines.append("No replies received.")
+        lossRate = 100.0 * self.lost / self.sent if self.sent else 0.0
+        lines.append("Package loss rate: %.1f%% (%i of %i)" % (lossRate, self.lost, self.sent))
+        bursts = self.loss_bursts()
+        if bursts:
+            numBursts = sum(bursts.values())
+            lines.append("Loss bursts: %i, mean length %.2f, longest %i" % (
+                numBursts, self.lost / numBursts, max(bursts)))
+        return "\n".join(lines)
@@ -0,0 +1,233 @@
+from socket import *
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import itertools
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Python script for benchmarking proxyServer.py without a real origin.
+# A local origin serves objects of the requested sizes after a fixed delay
+# and the proxy runs as a child process with an empty cache. For each size
+# the same set of URLs is requested twice by concurrent clients: the first
+# pass is all misses, the second all hits.
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "proxyServer.py")
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # GET /<size>/<id> returns <size> bytes after the server's latency. The
+    # body starts with the path, so every object is different: the proxy
+    # stores bodies by content hash and identical ones would share a blob.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes: with Nagle's algorithm the body
+    # would wait for the delayed ACK of the headers (~40 ms) on the proxy's
+    # kept-alive connections, and the benchmark would measure the origin
+    disable_nagle_algorithm = True
+    bodies = {}  # size -> filler the bodies of that size are made from
+    latency = 0.0
+    requests = 0
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        with self._lock:
+            OriginHandler.requests += 1
+        try:
+            size = int(self.path.split("/")[1])
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+        filler = self.bodies.get(size)
+        if filler is None:
+            filler = self.bodies.setdefault(size, b"x" * size)
+        tag = self.path.encode() + b"\n"
+        body = tag + filler[len(tag):] if size >= len(tag) else tag[-size:] if size else b""
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.send_header("Cache-Control", "max-age=3600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops the SYNs of a burst of new proxy
+    # connections, which then wait a second for the retransmission
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def free_port():
+    s = socket(AF_INET, SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_proxy(port, cacheDir, extraArgs):
+    proxy = subprocess.Popen([sys.executable, PROXY_SCRIPT, "127.0.0.1", "-p", str(port), "-d", cacheDir]
+                             + extraArgs, stdout=subprocess.DEVNULL, cwd=cacheDir)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            create_connection(("127.0.0.1", port), timeout=1).close()
+            return proxy
+        except OSError:
+            if proxy.poll() is not None:
+                break
+            time.sleep(0.05)
+    proxy.kill()
+    raise RuntimeError("the proxy did not start")
+
+
+def proxy_memory(pid):
+    # Current and peak resident set size of the proxy in KB, from /proc
+    # (Linux only)
+    values = {}
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    values[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+def fetch(proxyPort, url, timeoutSecs):
+    # Makes one GET request through the proxy and returns the bytes received
+    clientSocket = create_connection(("127.0.0.1", proxyPort), timeout=timeoutSecs)
+    try:
+        clientSocket.sendall(("GET /" + url + " HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n").encode())
+        nbytes = 0
+        first = clientSocket.recv(65536)
+        if not first.startswith(b"HTTP/1.1 200"):
+            raise ValueError("unexpected response: %r" % first[:40])
+        nbytes += len(first)
+        while True:
+            newData = clientSocket.recv(65536)
+            if not newData:
+                break
+            nbytes += len(newData)
+    finally:
+        clientSocket.close()
+    return nbytes
+
+
+def percentile(sortedValues, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sortedValues:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sortedValues))))
+    return sortedValues[rank - 1]
+
+
+def run_phase(proxyPort, urls, concurrency, timeoutSecs):
+    # Fetches every URL once with `concurrency` client threads. Returns the
+    # sorted latencies, bytes received, errors and elapsed time.
+    latencies = []
+    received = [0]
+    errors = [0]
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def client():
+        while True:
+            i = next(counter)
+            if i >= len(urls):
+                return
+            start = time.perf_counter()
+            try:
+                nbytes = fetch(proxyPort, urls[i], timeoutSecs)
+            except (OSError, ValueError):
+                with lock:
+                    errors[0] += 1
+                continue
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                received[0] += nbytes
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies), received[0], errors[0], time.perf_counter() - start
+
+
+def report(name, size, result, originRequests, memory):
+    latencies, received, errors, elapsed = result
+    completed = len(latencies)
+    rss, peak = memory
+    print("%-5s %9d %6d %6d %8d %9.3f %9.3f %9.3f %9.1f %9.2f %8s %8s" % (
+        name, size, completed, errors, originRequests,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        latencies[-1] * 1000 if latencies else 0.0,
+        completed / elapsed if elapsed else 0.0,
+        received / 1048576.0 / elapsed if elapsed else 0.0,
+        rss // 1024 if rss is not None else "n/a", peak // 1024 if peak is not None else "n/a"))
+
+
+def main(options):
+    OriginHandler.latency = options.latency / 1000.0
+    origin = OriginServer(("127.0.0.1", 0), OriginHandler)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    originAddress = "127.0.0.1:%d" % origin.server_address[1]
+
+    with tempfile.TemporaryDirectory() as cacheDir:
+        proxyPort = free_port()
+        # Every client may have a connection to the origin, so the proxy's
+        # per-origin limits (-o, -q) never answer 503; -a can still override
+        limits = ["-o", str(options.concurrency), "-q", str(options.concurrency)]
+        proxy = start_proxy(proxyPort, cacheDir, limits + shlex.split(options.proxy_args))
+        try:
+            print("Origin latency %.1f ms, %d clients, %d requests per pass" % (
+                options.latency, options.concurrency, options.num_requests))
+            print("%-5s %9s %6s %6s %8s %9s %9s %9s %9s %9s %8s %8s" % (
+                "pass", "size", "ok", "errors", "origin", "p50 ms", "p99 ms", "max ms",
+                "req/s", "MB/s", "RSS MB", "peak MB"))
+            for size in options.sizes:
+                urls = ["%s/%d/%d" % (originAddress, size, i) for i in range(options.num_requests)]
+                for name in ("miss", "hit"):
+                    before = OriginHandler.requests
+                    result = run_phase(proxyPort, urls, options.concurrency, options.timeout)
+                    report(name, size, result, OriginHandler.requests - before, proxy_memory(proxy.pid))
+        finally:
+            proxy.terminate()
+            proxy.wait()
+            origin.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the caching proxy against a local origin.')
+    parser.add_argument('-s', type=int, nargs='+', default=[1024, 65536, 1048576],
+                        dest='sizes',
+                        help='object sizes in bytes [int ..., default: %(default)s]')
+    parser.add_argument('-l', type=float, default=20.0,
+                        dest='latency',
+                        help='origin response delay in ms [float, default: %(default)s]')
+    parser.add_argument('-c', type=int, default=16,
+                        dest='concurrency',
+                        help='number of concurrent clients [int, default: %(default)s]')
+    parser.add_argument('-n', type=int, default=500,
+                        dest='num_requests',
+                        help='distinct objects per size, each fetched once per pass '
+                             '[int, default: %(default)s]')
+    parser.add_argument('-t', type=float, default=10.0,
+                        dest='timeout',
+                        help='per-request socket timeout in seconds [float, default: %(default)s]')
+    parser.add_argument('-a', default='',
+                        dest='proxy_args',
+                        help='extra options for proxyServer.py, e.g. "-w 64 -m 0" [str, default: none]')
+    main(parser.parse_args())
@@ -0,0 +1,598 @@
+# HTTP cache for the proxy (RFC 9111, shared-cache rules).
+#
+# Every cached response is a "<key>.meta" file, where key is the SHA-256 of
+# the URL, with the status line, the end-to-end headers and the
+# request/response times as JSON, plus the payload (chunked transfer coding
+# already removed). Payloads are content-addressed: they live in
+# "blobs/<digest>", where digest is the SHA-256 of the payload, so URLs
+# that return the same bytes share one file. A blob may be stored
+# compressed ("<digest>.gz" or ".zst") and is then decompressed as it is
+# sent. Bodies are written to "tmp/" first and both blobs and meta files
+# are renamed into place, so a reader never sees a partial object.
+# Freshness comes from Cache-Control s-maxage/max-age, Expires or, for
+# responses with Last-Modified only, a heuristic of 10% of their age. Stale
+# entries with an ETag or Last-Modified are revalidated with a conditional
+# request instead of being fetched again.
+
+from email.utils import formatdate, parsedate_to_datetime
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for zstd compression
+    zstandard = None
+
+from proxyHttp import CHUNK_SIZE, HOP_BY_HOP
+
+# Names of the files the cache creates. Anything else under the cache
+# directory is not ours and is never touched, even if -d points somewhere
+# with other files in it.
+SUBDIR_NAME = re.compile(r'[0-9a-f]{2}$')
+META_NAME = re.compile(r'([0-9a-f]{64})\.meta(\.tmp)?$')
+BLOB_NAME = re.compile(r'[0-9a-f]{64}(\.gz|\.zst)?$')
+TMP_NAME = re.compile(r'[0-9a-f]{32}\.body(\.gz|\.zst)?$')
+
+# Status codes that may be stored when the response allows it
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+# Headers of a 304 that must not overwrite the stored ones
+NOT_UPDATED_BY_304 = HOP_BY_HOP | {'content-length', 'content-encoding', 'content-range'}
+
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+
+# Bodies worth compressing at rest: text and a few text-based types that are
+# not already compressed, when they are large enough to shrink
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'}
+MIN_COMPRESS_SIZE = 256
+MIN_COMPRESS_SAVING = 0.1  # keep the raw blob unless compression saves 10%
+
+# Compression codecs for blobs: encoding -> (file suffix, compressor factory,
+# decompressor factory)
+CODECS = {'gzip': ('.gz', lambda: zlib.compressobj(6, zlib.DEFLATED, 31), lambda: zlib.decompressobj(31))}
+if zstandard is not None:
+    CODECS['zstd'] = ('.zst', lambda: zstandard.ZstdCompressor().compressobj(),
+                      lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+def parse_cache_control(value):
+    # "no-cache, max-age=60" -> {'no-cache': None, 'max-age': '60'}
+    directives = {}
+    for item in value.split(','):
+        name, sep, arg = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if sep else None
+    return directives
+
+
+def http_date(value):
+    # Returns an HTTP date as a timestamp, or None if missing or invalid.
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def delta_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_storable(status, headers):
+    if status not in CACHEABLE_STATUS:
+        return False
+    cacheControl = parse_cache_control(headers.get('cache-control', ''))
+    if 'no-store' in cacheControl or 'private' in cacheControl:
+        return False
+    if headers.get('vary', '').strip() == '*':
+        return False
+    return True
+
+
+def is_compressible(headers, size):
+    if size < MIN_COMPRESS_SIZE or 'content-encoding' in headers:
+        return False
+    mimeType = headers.get('content-type', '').partition(';')[0].strip().lower()
+    return mimeType.startswith('text/') or mimeType in COMPRESSIBLE_TYPES
+
+
+def iter_decompressed(f, encoding):
+    # Yields the payload of an open blob file in pieces of at most
+    # CHUNK_SIZE bytes (gzip) or one piece per CHUNK_SIZE bytes read (zstd)
+    if encoding == 'identity':
+        yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+        return
+    decompressor = CODECS[encoding][2]()
+    for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+        while data:
+            if encoding == 'gzip':
+                # Bounded output, so a highly compressed blob can't take
+                # a lot of memory at once
+                piece = decompressor.decompress(data, CHUNK_SIZE)
+                data = decompressor.unconsumed_tail
+            else:
+                piece, data = decompressor.decompress(data), b''
+            if piece:
+                yield piece
+
+
+class CacheEntry:
+    def __init__(self, url, statusLine, headers, requestTime, responseTime, bodyPath=None, bodySize=0,
+                 digest=None, encoding='identity'):
+        self.url = url  # type: string, host/path as requested from the proxy
+        self.statusLine = statusLine  # type: string
+        self.headers = headers  # type: dict, lower-cased names
+        self.requestTime = requestTime  # type: float, when the request was sent
+        self.responseTime = responseTime  # type: float, when the head arrived
+        self.bodyPath = bodyPath  # type: string, the blob file (None while being written)
+        self.bodySize = bodySize  # type: integer, size of the payload as sent to clients
+        self.digest = digest  # type: string, SHA-256 of the payload
+        self.encoding = encoding  # type: string, how the blob is stored ('identity', 'gzip', 'zstd')
+        self.body = None  # type: bytes, only for entries in the RAM tier
+
+    def __str__(self):
+        return ('CacheEntry(url=%s, status=%s, age=%d, lifetime=%d)'
+                % (self.url, self.statusLine, self.current_age(), self.freshness_lifetime()))
+
+    @property
+    def status(self):
+        return int(self.statusLine.split()[1])
+
+    def freshness_lifetime(self):
+        cacheControl = parse_cache_control(self.headers.get('cache-control', ''))
+        if 'no-cache' in cacheControl:
+            return 0
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cacheControl:
+                lifetime = delta_seconds(cacheControl[directive])
+                if lifetime is not None:
+                    return lifetime
+        date = http_date(self.headers.get('date')) or self.responseTime
+        if 'expires' in self.headers:
+            expires = http_date(self.headers['expires'])
+            return max(0, expires - date) if expires is not None else 0
+        lastModified = http_date(self.headers.get('last-modified'))
+        if lastModified is not None and lastModified < date:
+            return min(MAX_HEURISTIC_LIFETIME, (date - lastModified) * HEURISTIC_FRACTION)
+        return 0
+
+    def current_age(self, now=None):
+        if now is None:
+            now = time.time()
+        date = http_date(self.headers.get('date'))
+        apparentAge = max(0, self.responseTime - date) if date is not None else 0
+        ageValue = delta_seconds(self.headers.get('age')) or 0
+        responseDelay = self.responseTime - self.requestTime
+        correctedInitialAge = max(apparentAge, ageValue + responseDelay)
+        return correctedInitialAge + (now - self.responseTime)
+
+    def is_fresh(self, now=None):
+        return self.freshness_lifetime() > self.current_age(now)
+
+    def validators(self):
+        # Conditional request headers to revalidate this entry
+        conditional = {}
+        if 'etag' in self.headers:
+            conditional['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            conditional['If-Modified-Since'] = self.headers['last-modified']
+        return conditional
+
+    def response_head(self, complete=True):
+        # Head sent to a client served from the cache. While the body is
+        # still being written (complete=False) the length announced by the
+        # origin is used, if any.
+        lines = [self.statusLine]
+        for name, value in self.headers.items():
+            if name not in ('age', 'content-length'):
+                lines.append('%s: %s' % (name, value))
+        lines.append('Age: %d' % self.current_age())
+        if complete:
+            lines.append('Content-Length: %d' % self.bodySize)
+        elif 'content-length' in self.headers:
+            lines.append('Content-Length: %s' % self.headers['content-length'])
+        lines.append('Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def to_json(self):
+        return json.dumps({'url': self.url, 'statusLine': self.statusLine, 'headers': self.headers,
+                           'requestTime': self.requestTime, 'responseTime': self.responseTime,
+                           'blob': self.digest, 'encoding': self.encoding, 'bodySize': self.bodySize})
+
+
+class CacheWriter:
+    # Receives the body of a response while it is relayed to the client. It
+    # is written to tmpPath, hashed on the way, and only becomes visible on
+    # commit(), when it is moved to its blob and its meta file is written.
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+        self.tmpPath = os.path.join(cache.cacheDir, 'tmp', uuid.uuid4().hex + '.body')
+        self.bodyFile = open(self.tmpPath, 'wb')
+        self.hash = hashlib.sha256()
+
+    def write(self, piece):
+        self.bodyFile.write(piece)
+        self.hash.update(piece)
+        self.entry.bodySize += len(piece)
+
+    def flush(self):
+        # Makes the bytes written so far visible to readers of tmpPath
+        self.bodyFile.flush()
+
+    def commit(self):
+        self.bodyFile.close()
+        self.entry.digest = self.hash.hexdigest()
+        self.cache.store(self.entry, self.tmpPath)
+
+    def abort(self):
+        self.bodyFile.close()
+        try:
+            os.remove(self.tmpPath)
+        except OSError:
+            pass
+
+
+class Blob:
+    # A payload file shared by every entry whose body has its digest
+    def __init__(self, path, encoding, size):
+        self.path = path  # type: string
+        self.encoding = encoding  # type: string
+        self.size = size  # type: integer, bytes on disk
+        self.refs = 0  # entries in the index that use it
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0  # fresh entries served without contacting the origin
+        self.memoryHits = 0  # hits served from the RAM tier
+        self.revalidations = 0  # stale entries confirmed by a 304
+        self.coalesced = 0  # misses that shared another client's fetch
+        self.misses = 0  # responses fetched from the origin
+        self.bytesSaved = 0  # body bytes served from the cache
+        self.evictions = 0
+        self.deduplicated = 0  # stored bodies that were already in a blob
+        self._lock = threading.Lock()
+
+    def record_hit(self, entry):
+        with self._lock:
+            self.hits += 1
+            if entry.body is not None:
+                self.memoryHits += 1
+            self.bytesSaved += entry.bodySize
+
+    def record_revalidation(self, entry):
+        with self._lock:
+            self.revalidations += 1
+            self.bytesSaved += entry.bodySize
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def record_coalesced(self, nbytes):
+        with self._lock:
+            self.coalesced += 1
+            self.bytesSaved += nbytes
+
+    def report(self, cache):
+        requests = self.hits + self.revalidations + self.coalesced + self.misses
+        hitRatio = 100.0 * (requests - self.misses) / requests if requests else 0.0
+        return ('Cache report:\n'
+                'Requests:       %d\n'
+                'Hits:           %d (%d from memory)\n'
+                'Revalidations:  %d\n'
+                'Coalesced:      %d\n'
+                'Misses:         %d\n'
+                'Hit ratio:      %.1f%%\n'
+                'Bytes saved:    %d\n'
+                'Evictions:      %d\n'
+                'Disk usage:     %d / %d bytes in %d objects\n'
+                'Stored size:    %d bytes in %d blobs (%d deduplicated, compression: %s)\n'
+                'Memory usage:   %d / %d bytes in %d objects\n'
+                % (requests, self.hits, self.memoryHits, self.revalidations, self.coalesced,
+                   self.misses, hitRatio,
+                   self.bytesSaved, self.evictions, cache.diskBytes, cache.maxBytes, len(cache.index),
+                   cache.logicalBytes, len(cache.blobs), self.deduplicated, cache.compression or 'none',
+                   cache.memoryBytes, cache.maxMemoryBytes, len(cache.memory)))
+
+
+class HttpCache:
+    # Meta files live in cacheDir under the SHA-256 of their URL and bodies
+    # under "blobs/" by the SHA-256 of their content. The index keeps the
+    # entries in least-recently-used order, and the oldest ones are evicted
+    # when the bytes on disk exceed maxBytes; a blob is deleted with the
+    # last entry that uses it. Small objects that are hit again are also
+    # kept in memory, up to maxMemoryBytes.
+    MAX_BYTES = 256 * 1024 * 1024
+    MAX_MEMORY_BYTES = 32 * 1024 * 1024
+    MAX_MEMORY_OBJECT = 64 * 1024
+
+    def __init__(self, cacheDir='cache', maxBytes=MAX_BYTES, maxMemoryBytes=MAX_MEMORY_BYTES,
+                 maxMemoryObject=MAX_MEMORY_OBJECT, compression=None):
+        if compression is not None and compression not in CODECS:
+            raise ValueError('unsupported compression: %s' % compression)
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.maxMemoryBytes = maxMemoryBytes
+        self.maxMemoryObject = maxMemoryObject
+        self.compression = compression  # type: string or None, encoding for new blobs
+        self.stats = CacheStats()
+
+        # State.
+        self.index = OrderedDict()  # key -> (meta bytes, body size, digest), least recently used first
+        self.blobs = {}  # digest -> Blob
+        self.diskBytes = 0  # meta files plus blobs
+        self.logicalBytes = 0  # meta files plus bodies as if each entry had its own raw copy
+        self.memory = OrderedDict()  # key -> CacheEntry with its body loaded
+        self.memoryBytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(cacheDir, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(cacheDir, 'tmp'), exist_ok=True)
+        self._load_index()
+
+    def _key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cacheDir, key[:2], key + suffix)
+
+    def _blob_path(self, digest, encoding):
+        suffix = CODECS[encoding][0] if encoding != 'identity' else ''
+        return os.path.join(self.cacheDir, 'blobs', digest[:2], digest + suffix)
+
+    def _load_index(self):
+        # Rebuilds the index from the files left by a previous run, oldest
+        # first. Unfinished writes, meta files whose blob is missing and
+        # blobs no entry uses are deleted. Only names matching the patterns
+        # above are looked at.
+        for item in os.scandir(os.path.join(self.cacheDir, 'tmp')):
+            if item.is_file(follow_symlinks=False) and TMP_NAME.match(item.name):
+                os.remove(item.path)
+        blobFiles = {}
+        for sub in self._cache_subdirs(os.path.join(self.cacheDir, 'blobs')):
+            for item in os.scandir(sub.path):
+                if (item.is_file(follow_symlinks=False) and BLOB_NAME.match(item.name)
+                        and item.name.startswith(sub.name)):
+                    blobFiles[item.path] = item.stat().st_size
+
+        found = []
+        for sub in self._cache_subdirs(self.cacheDir):
+            for item in os.scandir(sub.path):
+                match = META_NAME.match(item.name)
+                if (match is None or not item.is_file(follow_symlinks=False)
+                        or not item.name.startswith(sub.name)):
+                    continue
+                key = match.group(1)
+                if match.group(2):
+                    # Left by an interrupted meta write
+                    os.remove(item.path)
+                    continue
+                try:
+                    with open(item.path) as f:
+                        meta = json.load(f)
+                    digest, encoding, bodySize = meta['blob'], meta['encoding'], meta['bodySize']
+                    blobPath = self._blob_path(digest, encoding)
+                except (OSError, ValueError, KeyError, TypeError):
+                    blobPath = None
+                if blobPath not in blobFiles:
+                    os.remove(item.path)
+                    continue
+                if digest not in self.blobs:
+                    self.blobs[digest] = Blob(blobPath, encoding, blobFiles[blobPath])
+                    self.diskBytes += blobFiles[blobPath]
+                metaSize = item.stat().st_size
+                found.append((item.stat().st_mtime, key, metaSize, bodySize, digest))
+
+        for mtime, key, metaSize, bodySize, digest in sorted(found):
+            self.index[key] = (metaSize, bodySize, digest)
+            self.blobs[digest].refs += 1
+            self.diskBytes += metaSize
+            self.logicalBytes += metaSize + bodySize
+        used = {blob.path for blob in self.blobs.values()}
+        for path in blobFiles:
+            if path not in used:
+                os.remove(path)
+        self._evict()
+
+    def _cache_subdirs(self, path):
+        # The "xx" directories (first two hex digits of a key or digest)
+        return [sub for sub in os.scandir(path)
+                if SUBDIR_NAME.match(sub.name) and sub.is_dir(follow_symlinks=False)]
+
+    def lookup(self, url):
+        key = self._key(url)
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.index.move_to_end(key)
+                return entry
+            if key not in self.index:
+                return None
+            self.index.move_to_end(key)
+        try:
+            with open(self._path(key, '.meta')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry = CacheEntry(meta['url'], meta['statusLine'], meta['headers'], meta['requestTime'],
+                           meta['responseTime'], self._blob_path(meta['blob'], meta['encoding']),
+                           meta['bodySize'], meta['blob'], meta['encoding'])
+        if entry.bodySize <= self.maxMemoryObject:
+            # Second use of a small object: promote it to the RAM tier
+            try:
+                entry.body = self.read_body(entry)
+            except (OSError, zlib.error):
+                return None
+            self._remember(key, entry)
+        return entry
+
+    def read_body(self, entry, limit=None):
+        # Returns the (decompressed) body of a stored entry, or its first
+        # `limit` bytes
+        pieces = []
+        size = 0
+        with open(entry.bodyPath, 'rb') as f:
+            for piece in iter_decompressed(f, entry.encoding):
+                pieces.append(piece)
+                size += len(piece)
+                if limit is not None and size >= limit:
+                    break
+        return b''.join(pieces)[:limit]
+
+    def _remember(self, key, entry):
+        with self._lock:
+            if key not in self.index:
+                return
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memoryBytes -= old.bodySize
+            self.memory[key] = entry
+            self.memoryBytes += entry.bodySize
+            while self.memoryBytes > self.maxMemoryBytes:
+                _, old = self.memory.popitem(last=False)
+                self.memoryBytes -= old.bodySize
+
+    def writer(self, url, statusLine, headers, requestTime, responseTime):
+        # Returns a CacheWriter for the response, or None if it can't be stored
+        if not is_storable(int(statusLine.split()[1]), headers):
+            self.remove(url)
+            return None
+        stored = {name: value for name, value in headers.items()
+                  if name not in HOP_BY_HOP and name != 'set-cookie'}
+        entry = CacheEntry(url, statusLine, stored, requestTime, responseTime)
+        # Hide the old version while the new body is being written
+        self.remove(url)
+        return CacheWriter(self, entry)
+
+    def store(self, entry, tmpPath):
+        # Moves a complete body written to tmpPath to the blob for its
+        # digest, unless that blob already exists, and writes the meta file
+        encoding = 'identity'
+        path = tmpPath
+        if (self.compression is not None and entry.digest not in self.blobs
+                and is_compressible(entry.headers, entry.bodySize)):
+            # Compressed outside the lock; the raw copy is kept when
+            # compression doesn't pay
+            compressedPath = tmpPath + CODECS[self.compression][0]
+            compressedSize = self._compress(tmpPath, compressedPath)
+            if compressedSize <= entry.bodySize * (1 - MIN_COMPRESS_SAVING):
+                os.remove(tmpPath)
+                encoding = self.compression
+                path = compressedPath
+            else:
+                os.remove(compressedPath)
+
+        with self._lock:
+            blob = self.blobs.get(entry.digest)
+            if blob is None:
+                blob = Blob(self._blob_path(entry.digest, encoding), encoding, os.path.getsize(path))
+                os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+                os.replace(path, blob.path)
+                self.blobs[entry.digest] = blob
+                self.diskBytes += blob.size
+            else:
+                os.remove(path)
+                self.stats.deduplicated += 1
+            entry.bodyPath = blob.path
+            entry.encoding = blob.encoding
+            self._write_meta(entry)
+
+    def _compress(self, srcPath, dstPath):
+        compressor = CODECS[self.compression][1]()
+        with open(srcPath, 'rb') as src, open(dstPath, 'wb') as dst:
+            for data in iter(lambda: src.read(CHUNK_SIZE), b''):
+                dst.write(compressor.compress(data))
+            dst.write(compressor.flush())
+            return dst.tell()
+
+    def refresh(self, entry, headers, requestTime, responseTime):
+        # Updates a stale entry with the headers of a 304 Not Modified
+        for name, value in headers.items():
+            if name not in NOT_UPDATED_BY_304 and name != 'set-cookie':
+                entry.headers[name] = value
+        if 'date' not in headers:
+            entry.headers['date'] = formatdate(responseTime, usegmt=True)
+        entry.headers.pop('age', None)
+        entry.requestTime = requestTime
+        entry.responseTime = responseTime
+        with self._lock:
+            if entry.digest in self.blobs:
+                self._write_meta(entry)
+
+    def _write_meta(self, entry):
+        # Must be called with the lock held and the entry's blob in self.blobs
+        key = self._key(entry.url)
+        metaPath = self._path(key, '.meta')
+        data = entry.to_json()
+        os.makedirs(os.path.dirname(metaPath), exist_ok=True)
+        with open(metaPath + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(metaPath + '.tmp', metaPath)
+        # The new blob is referenced before the old one is released, in
+        # case they are the same
+        self.blobs[entry.digest].refs += 1
+        item = self.index.pop(key, None)
+        if item is not None:
+            self._drop(item)
+        self.index[key] = (len(data), entry.bodySize, entry.digest)
+        self.diskBytes += len(data)
+        self.logicalBytes += len(data) + entry.bodySize
+        self._evict()
+
+    def _evict(self):
+        # Drops least recently used objects until the cache fits its budget.
+        # Must be called with the lock held (or before other threads start).
+        while self.diskBytes > self.maxBytes and self.index:
+            key, item = self.index.popitem(last=False)
+            self._forget(key, item)
+            self.stats.evictions += 1
+
+    def _forget(self, key, item):
+        # Must be called with the lock held, after removing key from the index.
+        # The meta file goes first so the entry disappears before its body.
+        # Readers that already opened the blob keep reading it.
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memoryBytes -= old.bodySize
+        self._remove_file(self._path(key, '.meta'))
+        self._drop(item)
+
+    def _drop(self, item):
+        # Gives back the space of an index item and its reference to a blob
+        metaSize, bodySize, digest = item
+        self.diskBytes -= metaSize
+        self.logicalBytes -= metaSize + bodySize
+        blob = self.blobs[digest]
+        blob.refs -= 1
+        if blob.refs == 0:
+            del self.blobs[digest]
+            self.diskBytes -= blob.size
+            self._remove_file(blob.path)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def remove(self, url):
+        key = self._key(url)
+        with self._lock:
+            item = self.index.pop(key, None)
+            if item is not None:
+                self._forget(key, item)
@@ -0,0 +1,129 @@
+# DNS cache for the proxy's origin connections.
+#
+# getaddrinfo() blocks and the system resolver usually doesn't cache, so
+# every miss used to pay a DNS round trip. Addresses are now kept for ttl
+# seconds and failures for negativeTtl seconds. Lookups run on a small
+# thread pool: concurrent requests for the same host wait on one lookup,
+# and an expired entry is still used (for up to staleTtl more seconds)
+# while it is refreshed in the background, so only the first request to a
+# host ever waits for the resolver.
+
+from socket import *
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class DnsEntry:
+    def __init__(self, addresses, error, expires):
+        self.addresses = addresses  # type: list of (family, type, proto, canonname, sockaddr)
+        self.error = error  # type: gaierror, UnicodeError (invalid name) or None
+        self.expires = expires  # type: float (time.monotonic())
+
+
+class DnsCache:
+    def __init__(self, ttl=300.0, negativeTtl=10.0, staleTtl=60.0, workers=4, maxEntries=4096):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.staleTtl = staleTtl
+        self.maxEntries = maxEntries
+
+        # State.
+        self.entries = {}  # (host, port) -> DnsEntry
+        self.pending = {}  # (host, port) -> Future of the lookup in progress
+        self.hits = 0
+        self.staleHits = 0
+        self.lookups = 0
+        self.failures = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dns')
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        # Returns the addresses of host as given by getaddrinfo(), or raises
+        # the gaierror of the last failed lookup
+        origin = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(origin)
+            if entry is not None and now < entry.expires:
+                self.hits += 1
+                return self._result(entry)
+            if entry is not None and entry.error is None and now < entry.expires + self.staleTtl:
+                # Serve the old addresses while they are refreshed
+                self.staleHits += 1
+                self._start_lookup(origin)
+                return entry.addresses
+            future = self._start_lookup(origin)
+        return self._result(future.result())
+
+    def connect(self, host, port, timeout=None):
+        # Tries each address of the host in turn, like create_connection()
+        error = None
+        for family, type, proto, canonname, sockaddr in self.resolve(host, port):
+            sock = socket(family, type, proto)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error if error is not None else OSError('no addresses for %s' % host)
+
+    def report(self):
+        with self._lock:
+            return ('DNS cache:\n'
+                    'Hits:           %d (%d stale)\n'
+                    'Lookups:        %d (%d failed)\n'
+                    'Entries:        %d\n'
+                    % (self.hits + self.staleHits, self.staleHits, self.lookups, self.failures,
+                       len(self.entries)))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _start_lookup(self, origin):
+        # Must be called with the lock held
+        future = self.pending.get(origin)
+        if future is None:
+            future = self._executor.submit(self._lookup, origin)
+            self.pending[origin] = future
+        return future
+
+    def _lookup(self, origin):
+        try:
+            addresses = getaddrinfo(origin[0], origin[1], type=SOCK_STREAM)
+            entry = DnsEntry(addresses, None, time.monotonic() + self.ttl)
+        except (gaierror, UnicodeError) as e:
+            # UnicodeError: the name cannot be encoded (e.g. a label over 63
+            # characters), so it is cached as a failure too
+            entry = DnsEntry([], e, time.monotonic() + self.negativeTtl)
+        with self._lock:
+            self.lookups += 1
+            if entry.error is not None:
+                self.failures += 1
+                old = self.entries.get(origin)
+                if old is not None and old.error is None and time.monotonic() < old.expires + self.staleTtl:
+                    # A failed refresh keeps the old addresses until they are
+                    # too stale to use
+                    entry = old
+            self.entries[origin] = entry
+            del self.pending[origin]
+            if len(self.entries) > self.maxEntries:
+                self._sweep()
+        return entry
+
+    def _sweep(self):
+        # Must be called with the lock held. Drops the entries that can no
+        # longer be used, then the oldest ones if that is not enough.
+        now = time.monotonic()
+        for origin, entry in list(self.entries.items()):
+            if now > entry.expires + self.staleTtl:
+                del self.entries[origin]
+        for origin in list(self.entries)[:len(self.entries) - self.maxEntries]:
+            del self.entries[origin]
+
+    def _result(self, entry):
+        if entry.error is not None:
+            raise entry.error
+        return entry.addresses
@@ -0,0 +1,112 @@
+# Request coalescing ("single flight") for the proxy.
+#
+# When several clients miss on the same URL at once, only the first one
+# (the leader) fetches it from the origin. The others (followers) wait for
+# the response head and then read the body from the cache file the leader
+# is writing, sending each piece as soon as the leader has flushed it, so
+# they get the bytes at the same pace as the leader's client.
+#
+# Only responses that will be stored are shared: if the response can't be
+# cached (private, no-store, ...) or the fetch fails before the head
+# arrives, the followers are released and fetch the object themselves.
+
+import threading
+
+from proxyHttp import CHUNK_SIZE
+
+
+class Flight:
+    def __init__(self):
+        self.entry = None  # CacheEntry of the response, once its head is known
+        self.tmpPath = None  # file the leader is writing the body to
+        self.size = 0  # bytes of the body flushed to tmpPath so far
+        self.done = False
+        self.ok = False  # True if the body was completed and committed
+        self.followers = 0
+        self._cond = threading.Condition()
+
+    def publish(self, entry, tmpPath):
+        with self._cond:
+            self.entry = entry
+            self.tmpPath = tmpPath
+            self._cond.notify_all()
+
+    def advance(self, nbytes):
+        with self._cond:
+            self.size += nbytes
+            self._cond.notify_all()
+
+    def finish(self, ok, callback=None):
+        # The callback (commit or abort of the cache file) runs with the lock
+        # held, so a follower never tries to open tmpPath after it is renamed
+        with self._cond:
+            try:
+                if callback is not None:
+                    callback()
+            finally:
+                self.ok = ok
+                self.done = True
+                self._cond.notify_all()
+
+    def follow(self, tcpCliSock):
+        # Streams the leader's response to the client. Returns the number of
+        # body bytes sent, or None if nothing was sent because the response
+        # is not shared or already finished (then the caller serves the
+        # request another way).
+        with self._cond:
+            while self.entry is None and not self.done:
+                self._cond.wait()
+            if self.done:
+                return None
+            entry = self.entry
+            # The file stays readable through this descriptor even if it is
+            # renamed or removed later
+            f = open(self.tmpPath, 'rb')
+
+        sent = 0
+        with f:
+            tcpCliSock.sendall(entry.response_head(complete=False))
+            while True:
+                with self._cond:
+                    while self.size == sent and not self.done:
+                        self._cond.wait()
+                    available = self.size
+                    done = self.done
+                    ok = self.ok
+                if done and not ok:
+                    raise OSError('origin response for %s was interrupted' % entry.url)
+                while sent < available:
+                    piece = f.read(min(CHUNK_SIZE, available - sent))
+                    if not piece:
+                        raise OSError('cache file for %s is truncated' % entry.url)
+                    tcpCliSock.sendall(piece)
+                    sent += len(piece)
+                if done:
+                    return sent
+
+
+class FlightTable:
+    # The fetches in progress, by URL
+    def __init__(self):
+        self.flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, url):
+        # Returns (flight, True) if the caller must fetch the URL itself, or
+        # the flight already in progress and False
+        with self._lock:
+            flight = self.flights.get(url)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = Flight()
+            self.flights[url] = flight
+            return flight, True
+
+    def leave(self, url, flight):
+        # Called by the leader when its fetch is over, whatever the outcome.
+        # Followers still waiting are released.
+        with self._lock:
+            if self.flights.get(url) is flight:
+                del self.flights[url]
+        flight.finish(flight.ok)
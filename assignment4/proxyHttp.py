@@ -0,0 +1,142 @@
+# HTTP message framing helpers for the proxy.
+#
+# HttpStream reads a response head from a socket and then yields the body
+# in pieces of at most CHUNK_SIZE bytes, so the proxy can relay it without
+# buffering the whole object. The end of the body is found from
+# Transfer-Encoding: chunked (whose framing is removed), Content-Length or,
+# failing both, the origin closing the connection.
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+
+# Headers that apply to one connection only
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+              'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade'}
+
+
+class HttpStreamError(Exception):
+    pass
+
+
+def parse_head(head):
+    # Splits a message head into its start line and a dict of lower-cased
+    # header names. Repeated headers are joined with ", ".
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HttpStreamError('malformed header line: %r' % line)
+        name = name.strip().lower()
+        if name in headers:
+            headers[name] += ', ' + value.strip()
+        else:
+            headers[name] = value.strip()
+    return lines[0], headers
+
+
+def rewrite_head(head):
+    # Drops the hop-by-hop header lines of a head received from the origin
+    # and marks the response as ending when the proxy closes the connection.
+    # Repeated headers such as Set-Cookie are kept as separate lines.
+    lines = head.decode('latin-1').split('\r\n')
+    kept = [lines[0]]
+    for line in lines[1:]:
+        if line and line.partition(':')[0].strip().lower() not in HOP_BY_HOP:
+            kept.append(line)
+    kept.append('Connection: close')
+    return ('\r\n'.join(kept) + '\r\n\r\n').encode('latin-1')
+
+
+def is_persistent(statusLine, headers, status):
+    # True if the connection can carry another request after this response:
+    # keep-alive is allowed and the body does not end with the connection.
+    connection = [token.strip().lower() for token in headers.get('connection', '').split(',')]
+    if 'close' in connection:
+        return False
+    if statusLine.startswith('HTTP/1.0') and 'keep-alive' not in connection:
+        return False
+    if status < 200 or status in (204, 304):
+        return True
+    return 'chunked' in headers.get('transfer-encoding', '').lower() or 'content-length' in headers
+
+
+def parse_status(statusLine):
+    parts = statusLine.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/') or not (parts[1].isascii() and parts[1].isdigit()):
+        raise HttpStreamError('malformed status line: %r' % statusLine)
+    return int(parts[1])
+
+
+class HttpStream:
+    def __init__(self, sock, chunkSize=CHUNK_SIZE):
+        self.sock = sock
+        self.chunkSize = chunkSize
+        self.buf = bytearray()
+
+    def _fill(self):
+        data = self.sock.recv(self.chunkSize)
+        self.buf += data
+        return len(data)
+
+    def read_until(self, delim, limit=MAX_HEAD_SIZE):
+        # Returns everything up to and including delim.
+        start = 0
+        while True:
+            i = self.buf.find(delim, start)
+            if i >= 0:
+                data = bytes(self.buf[:i + len(delim)])
+                del self.buf[:i + len(delim)]
+                return data
+            if len(self.buf) > limit:
+                raise HttpStreamError('line or head too long')
+            start = max(0, len(self.buf) - len(delim) + 1)
+            if not self._fill():
+                raise HttpStreamError('connection closed')
+
+    def read_head(self):
+        return self.read_until(b'\r\n\r\n')
+
+    def iter_raw(self, remaining):
+        # Yields the next `remaining` bytes, or everything until the peer
+        # closes if remaining is None.
+        while remaining is None or remaining > 0:
+            if not self.buf and not self._fill():
+                if remaining is None:
+                    return
+                raise HttpStreamError('connection closed')
+            take = len(self.buf) if remaining is None else min(remaining, len(self.buf))
+            piece = bytes(self.buf[:take])
+            del self.buf[:take]
+            if remaining is not None:
+                remaining -= take
+            yield piece
+
+    def iter_body(self, status, headers, method='GET'):
+        # Yields the body of a response with the given status and headers.
+        if method == 'HEAD' or status < 200 or status in (204, 304):
+            return
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                sizeLine = self.read_until(b'\r\n', 1024)
+                try:
+                    size = int(sizeLine.split(b';')[0].strip(), 16)
+                except ValueError:
+                    raise HttpStreamError('malformed chunk size')
+                if size == 0:
+                    # Skip the trailer section, ended by an empty line
+                    while self.read_until(b'\r\n') != b'\r\n':
+                        pass
+                    return
+                yield from self.iter_raw(size)
+                if self.read_until(b'\r\n', 2) != b'\r\n':
+                    raise HttpStreamError('malformed chunk')
+        elif 'content-length' in headers:
+            length = headers['content-length']
+            if not (length.isascii() and length.isdigit()):
+                raise HttpStreamError('malformed Content-Length')
+            yield from self.iter_raw(int(length))
+        else:
+            yield from self.iter_raw(None)
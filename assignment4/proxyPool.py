@@ -0,0 +1,146 @@
+# Keep-alive connection pool for the proxy's upstream requests.
+#
+# Connections to each origin are reused after a complete response, so
+# repeated misses to the same host skip the TCP handshake. At most
+# maxPerOrigin connections (busy or idle) are open to one origin; further
+# requests wait for one to be released. Waiting requests hold a worker
+# thread, so at most maxWaiters may wait per origin and the rest are
+# refused with PoolBusy: a slow origin cannot take every worker from the
+# clients of other origins. Idle connections are closed after
+# idleTimeout seconds, or as soon as the origin is seen to have closed them.
+# Origin host names are resolved through a DnsCache.
+
+from collections import defaultdict
+import select
+import threading
+import time
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, sock, origin):
+        self.sock = sock  # type: socket
+        self.origin = origin  # type: (host, port)
+        self.lastUsed = time.monotonic()
+        self.reused = False  # True if it already carried a previous request
+
+    def __str__(self):
+        return 'PooledConnection(origin=%s:%s, reused=%s)' % (self.origin[0], self.origin[1], self.reused)
+
+
+class ConnectionPool:
+    def __init__(self, resolver, maxPerOrigin=4, idleTimeout=30.0, socketTimeout=30.0, maxWaiters=8):
+        self.resolver = resolver  # type: DnsCache
+        self.maxPerOrigin = maxPerOrigin
+        self.maxWaiters = maxWaiters
+        self.idleTimeout = idleTimeout
+        self.socketTimeout = socketTimeout
+
+        # State.
+        self.idle = defaultdict(list)  # origin -> idle connections, most recent last
+        self.open = defaultdict(int)  # origin -> connections open, busy or idle
+        self.waiting = defaultdict(int)  # origin -> requests waiting for a connection
+        self.created = 0
+        self.reused = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, host, port):
+        # Returns an idle connection to the origin or opens a new one, waiting
+        # while the origin is at its connection limit. Raises PoolBusy if
+        # maxWaiters requests are already waiting for that origin.
+        origin = (host, port)
+        with self._cond:
+            while True:
+                idle = self.idle[origin]
+                while idle:
+                    conn = idle.pop()
+                    if self._usable(conn):
+                        conn.reused = True
+                        self.reused += 1
+                        return conn
+                    self._close(conn)
+                if self.open[origin] < self.maxPerOrigin:
+                    self.open[origin] += 1
+                    break
+                if self.waiting[origin] >= self.maxWaiters:
+                    self.rejected += 1
+                    raise PoolBusy('%d requests already waiting for %s:%s' % (self.waiting[origin], host, port))
+                self.waiting[origin] += 1
+                try:
+                    self._cond.wait()
+                finally:
+                    self.waiting[origin] -= 1
+                    if not self.waiting[origin]:
+                        del self.waiting[origin]
+
+        # Resolve and connect without holding the lock. Whatever goes wrong
+        # (an invalid host name raises UnicodeError), the slot is given back.
+        try:
+            sock = self.resolver.connect(host, port, self.socketTimeout)
+        except BaseException:
+            with self._cond:
+                self.open[origin] -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self.created += 1
+        return PooledConnection(sock, origin)
+
+    def release(self, conn, reusable):
+        # Returns a connection after use. It is kept for later requests only
+        # if the last response was read completely and allows keep-alive.
+        with self._cond:
+            if reusable:
+                conn.lastUsed = time.monotonic()
+                self.idle[conn.origin].append(conn)
+            else:
+                self._close(conn)
+            self._sweep()
+            self._cond.notify_all()
+
+    def report(self):
+        with self._cond:
+            idle = sum(len(conns) for conns in self.idle.values())
+            return ('Upstream connections:\n'
+                    'Created:        %d\n'
+                    'Reused:         %d\n'
+                    'Open:           %d (%d idle)\n'
+                    'Rejected:       %d (origin busy)\n'
+                    % (self.created, self.reused, sum(self.open.values()), idle, self.rejected))
+
+    def close_all(self):
+        with self._cond:
+            for idle in self.idle.values():
+                for conn in idle:
+                    self._close(conn)
+                idle.clear()
+
+    def _usable(self, conn):
+        if time.monotonic() - conn.lastUsed > self.idleTimeout:
+            return False
+        # An idle connection must not be readable: that means the origin
+        # closed it or sent something unexpected
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def _sweep(self):
+        # Closes connections that have been idle for too long
+        deadline = time.monotonic() - self.idleTimeout
+        for origin, idle in self.idle.items():
+            while idle and idle[0].lastUsed < deadline:
+                self._close(idle.pop(0))
+
+    def _close(self, conn):
+        # Must be called with the lock held
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+        self.open[conn.origin] -= 1
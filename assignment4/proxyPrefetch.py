@@ -0,0 +1,145 @@
+# Prefetching of the subresources of cached HTML pages.
+#
+# When an HTML page is stored in the cache, its images, scripts and style
+# sheets are likely to be requested right after it. The page is parsed in
+# the background and the same-origin subresources that are not cached yet
+# are fetched by a small pool of workers, so those requests are hits. The
+# work is bounded: at most maxPerPage resources per page and maxQueued
+# fetches waiting at a time; anything beyond that is dropped. Prefetched
+# URLs are remembered until their first request, which gives the prefetch
+# hit rate (prefetched objects that were actually used).
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+import threading
+
+# Only this much of a page is read to look for links
+MAX_PAGE_SIZE = 512 * 1024
+
+# rel values of <link> elements that name a resource the page will load
+LINK_RELS = {'stylesheet', 'icon', 'shortcut', 'preload', 'modulepreload'}
+
+
+class LinkParser(HTMLParser):
+    # Collects the URLs of the resources an HTML page loads
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in ('img', 'script', 'source', 'iframe', 'embed') and attrs.get('src'):
+            self.links.append(attrs['src'])
+        elif tag == 'link' and attrs.get('href'):
+            if LINK_RELS.intersection((attrs.get('rel') or '').lower().split()):
+                self.links.append(attrs['href'])
+
+
+def find_subresources(url, html, limit):
+    # Returns up to `limit` distinct subresources of the page at url (in the
+    # proxy's "host/path" form) that are on the same origin
+    parser = LinkParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except AssertionError:
+        # Badly broken markup; keep the links found so far
+        pass
+    base = 'http://' + url
+    host = urlsplit(base).netloc
+    found = []
+    for link in parser.links:
+        parts = urlsplit(urljoin(base, link.strip()))
+        if parts.scheme != 'http' or parts.netloc != host:
+            continue
+        target = parts.netloc + (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if target != url and target not in found:
+            found.append(target)
+            if len(found) == limit:
+                break
+    return found
+
+
+class Prefetcher:
+    def __init__(self, cache, fetch, workers=2, maxQueued=64, maxPerPage=32, maxTracked=4096):
+        self.cache = cache  # type: HttpCache
+        self.fetch = fetch  # type: function(url) that stores url in the cache
+        self.maxQueued = maxQueued
+        self.maxPerPage = maxPerPage
+        self.maxTracked = maxTracked
+
+        # State.
+        self.queued = set()  # URLs waiting for or being fetched
+        self.unused = OrderedDict()  # prefetched URLs not requested yet, oldest first
+        self.pages = 0
+        self.scheduled = 0
+        self.dropped = 0
+        self.fetched = 0
+        self.hits = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+
+    def page_cached(self, url, entry):
+        # Called when an HTML page was stored. Parsing happens on a worker,
+        # not on the thread serving the page.
+        if 'html' not in entry.headers.get('content-type', '') or 'content-encoding' in entry.headers:
+            return
+        self._executor.submit(self._scan, url, entry)
+
+    def claim(self, url):
+        # Called when a client gets url from the cache. Counts a prefetch hit
+        # the first time a prefetched object is used.
+        with self._lock:
+            if url in self.unused:
+                del self.unused[url]
+                self.hits += 1
+
+    def report(self):
+        with self._lock:
+            hitRate = 100.0 * self.hits / self.fetched if self.fetched else 0.0
+            return ('Prefetch:\n'
+                    'Pages scanned:  %d\n'
+                    'Scheduled:      %d (%d dropped)\n'
+                    'Fetched:        %d\n'
+                    'Used:           %d (%.1f%%)\n'
+                    % (self.pages, self.scheduled, self.dropped, self.fetched, self.hits, hitRate))
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _scan(self, url, entry):
+        try:
+            html = self.cache.read_body(entry, MAX_PAGE_SIZE)
+        except OSError:
+            return
+        links = find_subresources(url, html.decode('utf-8', 'replace'), self.maxPerPage)
+        with self._lock:
+            self.pages += 1
+        for link in links:
+            cached = self.cache.lookup(link)
+            if cached is not None and cached.is_fresh():
+                continue
+            with self._lock:
+                if link in self.queued or link in self.unused:
+                    continue
+                if len(self.queued) >= self.maxQueued:
+                    self.dropped += 1
+                    continue
+                self.queued.add(link)
+                self.scheduled += 1
+            self._executor.submit(self._fetch, link)
+
+    def _fetch(self, url):
+        try:
+            stored = self.fetch(url)
+        finally:
+            with self._lock:
+                self.queued.discard(url)
+        if stored:
+            with self._lock:
+                self.fetched += 1
+                self.unused[url] = True
+                while len(self.unused) > self.maxTracked:
+                    self.unused.popitem(last=False)
@@ -1,123 +1,435 @@
 from socket import *
-import sys
-
-if len(sys.argv) <= 1:
-    print('Usage : "python proxy.py server_ip"\n[server_ip : It is the IP Address Of Proxy Server')
-    sys.exit(2)
-
-# Create a server socket, bind it to a port and start listening
-tcpSerSock = socket(AF_INET, SOCK_STREAM)
-# Fill in start
-tcpSerSock.bind(("localhost", 9595))
-tcpSerSock.listen(10)
-# Fill in end
-
-while 1:
-    # Start receiving data from the client
-    print('Ready to serve...')
-    tcpCliSock, addr = tcpSerSock.accept()
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+import traceback
+
+from proxyCache import CODECS, HttpCache, iter_decompressed
+from proxyDns import DnsCache
+from proxyFlight import FlightTable
+from proxyHttp import HttpStream, HttpStreamError, is_persistent, parse_head, parse_status, rewrite_head
+from proxyPool import ConnectionPool, PoolBusy
+from proxyPrefetch import Prefetcher
+from proxyTunnel import Tunnel, TunnelRelay, TunnelStats
+
+# Seconds to wait on a slow client or origin before giving up
+SOCKET_TIMEOUT = 30
+
+# Shared HTTP cache, DNS cache and upstream connection pool, created in main()
+cache = None
+resolver = None
+pool = None
+
+# Origin fetches in progress, shared by concurrent misses on the same URL
+flights = FlightTable()
+
+# CONNECT tunnels: allowed destination ports, idle timeout (set in main()),
+# the thread relaying them (started in main()) and counters
+CONNECT_PORTS = {443}
+TUNNEL_IDLE_TIMEOUT = 60.0
+tunnelRelay = None
+tunnelStats = TunnelStats()
+
+# Background fetcher of the subresources of cached pages, if enabled
+prefetcher = None
+
+# Request path that returns the cache statistics instead of an object
+STATS_PATH = "cache-stats"
+
+
+def handle_client(tcpCliSock, addr):
     print('Received a connection from:', addr)
+    tcpCliSock.settimeout(SOCKET_TIMEOUT)
+    try:
+        data = tcpCliSock.recv(4096)
+        if not data:
+            return
+        if data.startswith(b'CONNECT '):
+            if handle_connect(tcpCliSock, data):
+                # The tunnel relay owns the socket now
+                tcpCliSock = None
+            return
+        message = data.decode()
 
-    message = tcpCliSock.recv(4096).decode()
+        # Extract the filename from the given message. Both "GET /host/path"
+        # and the absolute form "GET http://host/path" are accepted.
+        target = message.split()[1]
+        if target.startswith('http://'):
+            filename = target[len('http://'):]
+        else:
+            filename = target.partition("/")[2]
+        print(message.split('\r\n')[0])
 
-    if not message:
-        continue
+        if filename == STATS_PATH:
+            body = report().encode()
+            tcpCliSock.sendall(("HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                                "Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body)).encode() + body)
+            return
 
-    print(message)
+        # Check whether the file exists in the cache and is still fresh
+        entry = cache.lookup(filename)
+        if entry is not None and entry.is_fresh() and serve_hit(tcpCliSock, filename, entry):
+            return
 
-    # Extract the filename from the given message
-    print(message.split()[1])
-    filename = message.split()[1].partition("/")[2]
-    print(filename)
+        # Only one client fetches a missing or stale object from the origin;
+        # the others that arrive meanwhile are sent the same response
+        flight, leader = flights.join(filename)
+        if not leader:
+            sent = flight.follow(tcpCliSock)
+            if sent is not None:
+                cache.stats.record_coalesced(sent)
+                if prefetcher is not None:
+                    prefetcher.claim(filename)
+                print('Coalesced:', filename)
+                return
+            # The response was not shared: it is in the cache now, or it
+            # could not be stored and we must fetch our own copy
+            entry = cache.lookup(filename)
+            if entry is not None and entry.is_fresh() and serve_hit(tcpCliSock, filename, entry):
+                return
+            flight = None
+        try:
+            fetch_from_origin(tcpCliSock, filename, entry, flight)
+        finally:
+            if leader:
+                flights.leave(filename, flight)
+    except (OSError, IndexError, UnicodeDecodeError) as e:
+        print("Error serving %s: %s" % (addr, e))
+    except Exception:
+        # A bug: the executor would drop it silently
+        print("Unexpected error serving %s:" % (addr,))
+        traceback.print_exc()
+    finally:
+        if tcpCliSock is not None:
+            tcpCliSock.close()
 
-    fileExist = False
 
+def handle_connect(tcpCliSock, data):
+    # "CONNECT host:port HTTP/1.1": open a tunnel to host:port and hand it
+    # to the tunnel relay, so it does not hold this worker thread. Anything
+    # after the request head is already tunnel data. Returns True if the
+    # tunnel was opened.
+    head, sep, rest = data.partition(b'\r\n\r\n')
+    if not sep:
+        tcpCliSock.sendall(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+        return False
+    requestLine = head.split(b'\r\n')[0].decode('latin-1')
+    print(requestLine)
+    host, _, port = requestLine.split()[1].rpartition(':')
+    host = host.strip('[]')  # IPv6 literals come as [addr]:port
+    if not host or not (port.isascii() and port.isdigit()) or int(port) not in CONNECT_PORTS:
+        tunnelStats.record_failure()
+        tcpCliSock.sendall(b"HTTP/1.1 403 Forbidden\r\nConnection: close\r\n\r\n")
+        return False
+    try:
+        originSock = resolver.connect(host, int(port), SOCKET_TIMEOUT)
+    except (OSError, UnicodeError) as e:
+        print("Illegal request: %s" % e)
+        tunnelStats.record_failure()
+        tcpCliSock.sendall(b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n")
+        return False
     try:
-        # Check whether the file exists in the cache
-        f = open(filename, "r", encoding='utf-8')
-        fileExist = True
-        outputData = f.readlines()
-
-        # ProxyServer finds a cache hit and generates a response message
-        tcpCliSock.send("HTTP/1.0 200 OK\r\n".encode())
-        tcpCliSock.send("Content-Type:text/html\r\n".encode())
-
-        # Fill in start
-        for o in outputData:
-            tcpCliSock.send(o.encode())
-
-        # Fill in end
-
-        print('Read from cache')
-
-    # Error handling for file not found in cache
-    except IOError:
-        if fileExist == False:
-            # Create a socket on the proxyserver
-            c = socket(AF_INET, SOCK_STREAM)
-            hostn = filename.replace("www.", "", 1)
-
-            serverName = filename.partition("/")[0]
-            askFile = 'http://' + serverName if ''.join(filename.partition('/')[1:]) == '' else ''.join(
-                filename.partition('/')[1:])
-
-            print(hostn)
-            print(serverName, askFile)
-
-            try:
-                # Connect to the socket to port 80
-                # Fill in start
-                c.connect((serverName, 80))
-                # Fill in end
-
-                # Create a temporary file on this socket and ask port 80
-                # for the file requested by the client
-                fileObj = c.makefile('rwb', None)
-                h = "GET " + askFile + " HTTP/1.1\r\nHost: " + serverName + '\r\n\r\n'
-                fileObj.write(h.encode())
-
-                # Read the response into a buffer
-                # Fill in start
-                fileObj.flush()
-
-                responseBuffer = fileObj.readlines()
-
-                if responseBuffer[0] == b'404':
-                    print('404')
-                    tcpCliSock.send("HTTP/1.1 404 Not Found\r\n\r\n".encode())
-                    tcpCliSock.close()
-                    continue
-
-                line = responseBuffer[0].decode()
-                code = int(line.split()[1])
-
-                for r in responseBuffer:
-                    tcpCliSock.send(r)
-
-                # Fill in end
-
-                # Create a new file in the cache for the requested file
-                # Also send the response in the buffer to the client socket
-                # and the corresponding file in the cache
-                tmpFile = open("./" + filename, "wb")
-
-                # Fill in start
-                for r in responseBuffer:
-                    tmpFile.write(r)
-
-                tmpFile.close()
-                # Fill in end
-            except:
-                print("Illegal request")
+        tcpCliSock.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        tunnel = Tunnel(tcpCliSock, originSock, TUNNEL_IDLE_TIMEOUT,
+                        lambda tunnel: tunnel_closed(tunnel, host, port))
+        tunnelRelay.add(tunnel, rest)
+    except OSError:
+        originSock.close()
+        raise
+    tunnelStats.record_open()
+    return True
+
+
+def tunnel_closed(tunnel, host, port):
+    bytesUp, bytesDown = tunnel.upstream.nbytes, tunnel.downstream.nbytes
+    tunnelStats.record_close(bytesUp, bytesDown)
+    print('Tunnel to %s:%s closed: %d bytes up, %d bytes down' % (host, port, bytesUp, bytesDown))
+
+
+def serve_hit(tcpCliSock, filename, entry):
+    # Returns False if the body is gone (replaced or evicted since the
+    # lookup) and nothing was sent
+    try:
+        send_from_cache(tcpCliSock, entry)
+    except FileNotFoundError:
+        return False
+    cache.stats.record_hit(entry)
+    if prefetcher is not None:
+        prefetcher.claim(filename)
+    print('Read from cache:', filename)
+    return True
+
+
+class NullClient:
+    # Stands in for the client socket when the proxy fetches an object only
+    # to store it
+    def send(self, data):
+        return len(data)
+
+    def sendall(self, data):
+        pass
+
+    def sendfile(self, f):
+        return 0
+
+
+def prefetch(filename):
+    # Fetches filename into the cache for the prefetcher, unless it is
+    # already cached or being fetched. Returns True if it was stored.
+    entry = cache.lookup(filename)
+    if entry is not None and entry.is_fresh():
+        return False
+    flight, leader = flights.join(filename)
+    if not leader:
+        return False
+    try:
+        return fetch_from_origin(NullClient(), filename, entry, flight, prefetching=True)
+    finally:
+        flights.leave(filename, flight)
+
+
+def send_from_cache(tcpCliSock, entry):
+    # The stored headers are sent with the current Age, followed by the
+    # cached body from memory or from disk. A raw blob is sent with
+    # sendfile(), a compressed one is decompressed as it is sent.
+    if entry.body is not None:
+        tcpCliSock.sendall(entry.response_head() + entry.body)
+        return
+    with open(entry.bodyPath, "rb") as f:
+        tcpCliSock.sendall(entry.response_head())
+        if entry.encoding == 'identity':
+            tcpCliSock.sendfile(f)
         else:
-            # HTTP response message for file not found
-            # Fill in start
-            tcpCliSock.send("HTTP/1.0 404 NOT FOUND\r\n".encode())
-            tcpCliSock.send("Content-Type:text/html\r\n".encode())
-            tcpCliSock.send(
-                "<html><head><title>Not Found</title></head><body><h1>Not Found</h1></body></html>".encode())
-            # Fill in end
-
-# Close the client and the server sockets
-tcpCliSock.close()
-tcpSerSock.close()
+            for piece in iter_decompressed(f, entry.encoding):
+                tcpCliSock.sendall(piece)
+
+
+def fetch_from_origin(tcpCliSock, filename, entry=None, flight=None, prefetching=False):
+    # Fetches the object from the origin. If a stale cache entry is given,
+    # the request is made conditional so a 304 lets us reuse its body. If a
+    # flight is given, the response is shared with its followers. Returns
+    # True if the object is now in the cache. Prefetches are left out of
+    # the cache statistics and do not trigger more prefetching.
+    serverName = filename.partition("/")[0]
+    askFile = 'http://' + serverName if ''.join(filename.partition('/')[1:]) == '' else ''.join(
+        filename.partition('/')[1:])
+
+    # The origin may be given as host:port
+    host, _, port = serverName.partition(":")
+    port = int(port) if port.isascii() and port.isdigit() else 80
+
+    h = "GET " + askFile + " HTTP/1.1\r\nHost: " + serverName + "\r\n"
+    if entry is not None:
+        for name, value in entry.validators().items():
+            h += name + ": " + value + "\r\n"
+    h += "\r\n"
+
+    # Reuse a kept-alive connection to the origin if there is one. A reused
+    # connection may have been closed by the origin in the meantime, in
+    # which case the request is retried once on a new connection.
+    for attempt in range(2):
+        try:
+            requestTime = time.time()
+            conn = pool.acquire(host, port)
+        except PoolBusy as e:
+            print("Origin busy: %s" % e)
+            tcpCliSock.send("HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nConnection: close\r\n\r\n".encode())
+            return False
+        except (OSError, UnicodeError) as e:
+            # UnicodeError: not a valid host name (e.g. a label over 63 characters)
+            print("Illegal request: %s" % e)
+            tcpCliSock.send("HTTP/1.1 502 Bad Gateway\r\n\r\n".encode())
+            return False
+        try:
+            conn.sock.sendall(h.encode())
+            stream = HttpStream(conn.sock)
+            head = stream.read_head()
+            responseTime = time.time()
+            statusLine, headers = parse_head(head)
+            status = parse_status(statusLine)
+            break
+        except (OSError, HttpStreamError) as e:
+            pool.release(conn, False)
+            if conn.reused and attempt == 0:
+                continue
+            print("Illegal request: %s" % e)
+            tcpCliSock.send("HTTP/1.1 502 Bad Gateway\r\n\r\n".encode())
+            return False
+
+    reusable = False
+    try:
+        if status == 304 and entry is not None:
+            # The cached copy is still valid
+            reusable = is_persistent(statusLine, headers, status)
+            cache.refresh(entry, headers, requestTime, responseTime)
+            if flight is not None:
+                # Followers can read the refreshed entry from the cache
+                flight.finish(True)
+            send_from_cache(tcpCliSock, entry)
+            if not prefetching:
+                cache.stats.record_revalidation(entry)
+                # The prefetched body was used, even if it had to be revalidated
+                if prefetcher is not None:
+                    prefetcher.claim(filename)
+            print('Revalidated:', filename)
+            return True
+
+        if not prefetching:
+            cache.stats.record_miss()
+        cacheWriter = cache.writer(filename, statusLine, headers, requestTime, responseTime)
+        if flight is not None:
+            if cacheWriter is not None:
+                flight.publish(cacheWriter.entry, cacheWriter.tmpPath)
+            else:
+                # Not storable, so not shared either: let the followers go
+                flight.finish(False)
+                flight = None
+        complete = relay_response(tcpCliSock, filename, stream, head, status, headers, cacheWriter, flight)
+        reusable = complete and is_persistent(statusLine, headers, status) and not stream.buf
+        stored = complete and cacheWriter is not None
+        if stored and prefetcher is not None and not prefetching:
+            prefetcher.page_cached(filename, cacheWriter.entry)
+        return stored
+    finally:
+        pool.release(conn, reusable)
+
+
+def relay_response(tcpCliSock, filename, stream, head, status, headers, cacheWriter, flight=None):
+    # Send each piece of the response to the client as soon as it arrives
+    # and write it to the cache at the same time, so memory use does not
+    # depend on the size of the object. Pieces are flushed as they come when
+    # followers read the cache file. Returns True if the whole response was
+    # read from the origin.
+    clientAlive = True
+    complete = False
+    try:
+        tcpCliSock.sendall(rewrite_head(head))
+        for piece in stream.iter_body(status, headers):
+            if clientAlive:
+                try:
+                    tcpCliSock.sendall(piece)
+                except OSError:
+                    # Keep reading so the cache entry is still completed
+                    clientAlive = False
+            if cacheWriter is not None:
+                cacheWriter.write(piece)
+                if flight is not None:
+                    cacheWriter.flush()
+                    flight.advance(len(piece))
+        complete = True
+    except (OSError, HttpStreamError) as e:
+        print("Error relaying %s: %s" % (filename, e))
+    finally:
+        if cacheWriter is not None:
+            # Never leave a truncated object in the cache
+            finish = cacheWriter.commit if complete else cacheWriter.abort
+            if flight is not None:
+                flight.finish(complete, finish)
+            else:
+                finish()
+            if complete:
+                print('Cached:', filename)
+    return complete
+
+
+def report():
+    text = cache.stats.report(cache) + pool.report() + resolver.report() + tunnelStats.report()
+    if prefetcher is not None:
+        text += prefetcher.report()
+    return text
+
+
+def main(options):
+    global cache, resolver, pool, prefetcher, tunnelRelay, CONNECT_PORTS, TUNNEL_IDLE_TIMEOUT
+    CONNECT_PORTS = set(options.connect_ports)
+    TUNNEL_IDLE_TIMEOUT = options.tunnel_timeout
+    resolver = DnsCache(options.dns_ttl, options.dns_negative_ttl)
+    pool = ConnectionPool(resolver, options.max_per_origin, options.idle_timeout, SOCKET_TIMEOUT,
+                          options.max_waiters)
+    cache = HttpCache(options.cache_dir, int(options.cache_size * 1024 * 1024),
+                      int(options.memory_size * 1024 * 1024), compression=options.compression)
+    if options.prefetch_workers > 0:
+        prefetcher = Prefetcher(cache, prefetch, options.prefetch_workers)
+    tunnelRelay = TunnelRelay()
+
+    # Create a server socket, bind it to a port and start listening
+    tcpSerSock = socket(AF_INET, SOCK_STREAM)
+    tcpSerSock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    tcpSerSock.bind((options.server_ip, options.port))
+    tcpSerSock.listen(128)
+
+    # Every client is served by a worker thread. A slow origin can hold at
+    # most -o + -q of them (fetching and waiting); further requests to it
+    # get a 503, so the other origins' clients are still served.
+    with ThreadPoolExecutor(max_workers=options.workers) as workers:
+        print('Ready to serve...')
+        try:
+            while True:
+                tcpCliSock, addr = tcpSerSock.accept()
+                workers.submit(handle_client, tcpCliSock, addr)
+        except KeyboardInterrupt:
+            print(report())
+        finally:
+            # Close the server socket
+            tcpSerSock.close()
+            pool.close_all()
+            resolver.close()
+            tunnelRelay.close()
+            if prefetcher is not None:
+                prefetcher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Caching web proxy.',
+                                     usage='python proxyServer.py server_ip [options]')
+    parser.add_argument('server_ip',
+                        help='IP address of the proxy server')
+    parser.add_argument('-p', type=int, default=9595,
+                        dest='port',
+                        help='port to listen on [int, default: %(default)s]')
+    parser.add_argument('-w', type=int, default=32,
+                        dest='workers',
+                        help='number of worker threads [int, default: %(default)s]')
+    parser.add_argument('-o', type=int, default=4,
+                        dest='max_per_origin',
+                        help=('maximum connections per origin host '
+                              '[int, default: %(default)s]'))
+    parser.add_argument('-q', type=int, default=8,
+                        dest='max_waiters',
+                        help=('maximum requests waiting for a connection to one origin host; '
+                              'more get a 503 [int, default: %(default)s]'))
+    parser.add_argument('-i', type=float, default=30.0,
+                        dest='idle_timeout',
+                        help=('seconds an idle origin connection is kept open '
+                              '[float, default: %(default)s]'))
+    parser.add_argument('-t', type=float, default=300.0,
+                        dest='dns_ttl',
+                        help='seconds a resolved origin address is cached [float, default: %(default)s]')
+    parser.add_argument('-n', type=float, default=10.0,
+                        dest='dns_negative_ttl',
+                        help=('seconds a failed origin lookup is cached '
+                              '[float, default: %(default)s]'))
+    parser.add_argument('-c', type=int, nargs='+', default=[443],
+                        dest='connect_ports',
+                        help='ports CONNECT tunnels may open [int ..., default: %(default)s]')
+    parser.add_argument('-T', type=float, default=60.0,
+                        dest='tunnel_timeout',
+                        help='seconds an idle CONNECT tunnel is kept open [float, default: %(default)s]')
+    parser.add_argument('-P', type=int, default=0,
+                        dest='prefetch_workers',
+                        help=('threads prefetching the subresources of cached HTML pages, '
+                              '0 to disable [int, default: %(default)s]'))
+    parser.add_argument('-z', choices=sorted(CODECS), default=None,
+                        dest='compression',
+                        help=('compress cached text bodies at rest; zstd needs the zstandard '
+                              'package [str, default: no compression]'))
+    parser.add_argument('-d', default='cache',
+                        dest='cache_dir',
+                        help='directory for cached objects [str, default: %(default)s]')
+    parser.add_argument('-s', type=float, default=256,
+                        dest='cache_size',
+                        help='disk cache budget in MB [float, default: %(default)s]')
+    parser.add_argument('-m', type=float, default=32,
+                        dest='memory_size',
+                        help='in-memory tier budget in MB [float, default: %(default)s]')
+    main(parser.parse_args())
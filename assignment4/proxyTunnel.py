@@ -0,0 +1,235 @@
+# CONNECT tunnels for the proxy.
+#
+# After "CONNECT host:port" the proxy opens a TCP connection to host:port
+# and copies bytes both ways until either side is done, so HTTPS (or any
+# other protocol) can pass through without the proxy looking into it.
+# Tunnels can stay open for minutes, so they are not given a thread each:
+# one TunnelRelay thread watches the sockets of every tunnel with a single
+# selector. The sockets are non-blocking; each direction has its own fixed
+# buffer that recv_into() fills and send() drains, so no data is copied or
+# decoded in Python. A direction only reads again once its buffer has been
+# sent, which also gives back-pressure when one side is slower. A tunnel is
+# closed after idleTimeout seconds without traffic.
+
+from socket import *
+import selectors
+import threading
+import time
+import traceback
+
+BUFFER_SIZE = 64 * 1024
+
+# Seconds between checks for idle tunnels
+SWEEP_INTERVAL = 1.0
+
+
+class Pipe:
+    # One direction of a tunnel: reads from src and writes to dst
+    def __init__(self, src, dst, bufferSize):
+        self.src = src
+        self.dst = dst
+        self.buf = memoryview(bytearray(bufferSize))
+        self.start = 0  # bytes in buf[start:end] are waiting to be sent
+        self.end = 0
+        self.eof = False  # src closed its side and everything was sent
+        self.nbytes = 0
+
+    def wants_read(self):
+        return not self.eof and self.start == self.end
+
+    def wants_write(self):
+        return self.start < self.end
+
+    def read(self):
+        n = self.src.recv_into(self.buf)
+        if n == 0:
+            self.eof = True
+            # Pass the half-close on, so the other side sees the end of data
+            try:
+                self.dst.shutdown(SHUT_WR)
+            except OSError:
+                pass
+            return
+        self.start, self.end = 0, n
+        self.nbytes += n
+        # Most of the time dst can take it right away
+        self.write()
+
+    def write(self):
+        try:
+            self.start += self.dst.send(self.buf[self.start:self.end])
+        except BlockingIOError:
+            pass
+
+
+class Tunnel:
+    def __init__(self, client, origin, idleTimeout=60.0, onClose=None, bufferSize=BUFFER_SIZE):
+        self.client = client
+        self.origin = origin
+        self.idleTimeout = idleTimeout
+        self.onClose = onClose  # type: function(tunnel), called from the relay thread once closed
+        self.upstream = Pipe(client, origin, bufferSize)  # client -> origin
+        self.downstream = Pipe(origin, client, bufferSize)  # origin -> client
+        self.lastActivity = time.monotonic()
+        self.failed = False
+        self.registered = {}  # socket -> selector events watched
+
+    def done(self):
+        return self.failed or (self.upstream.eof and self.downstream.eof)
+
+    def handle(self, sock, events):
+        # Called by the relay when sock is ready
+        self.lastActivity = time.monotonic()
+        try:
+            for pipe in (self.upstream, self.downstream):
+                if events & selectors.EVENT_WRITE and pipe.dst is sock and pipe.wants_write():
+                    pipe.write()
+                if events & selectors.EVENT_READ and pipe.src is sock and pipe.wants_read():
+                    pipe.read()
+        except OSError:
+            # A reset from either side ends the tunnel
+            self.failed = True
+
+    def watch(self, sel):
+        # Watches each socket only for what its pipes can do now
+        for sock in (self.client, self.origin):
+            events = 0
+            for pipe in (self.upstream, self.downstream):
+                if pipe.src is sock and pipe.wants_read():
+                    events |= selectors.EVENT_READ
+                if pipe.dst is sock and pipe.wants_write():
+                    events |= selectors.EVENT_WRITE
+            registered = self.registered.get(sock, 0)
+            if events != registered:
+                if not events:
+                    sel.unregister(sock)
+                elif registered:
+                    sel.modify(sock, events, self)
+                else:
+                    sel.register(sock, events, self)
+                self.registered[sock] = events
+
+    def close(self, sel):
+        for sock in (self.client, self.origin):
+            if self.registered.get(sock):
+                sel.unregister(sock)
+            sock.close()
+        self.registered.clear()
+        if self.onClose is not None:
+            self.onClose(self)
+
+
+class TunnelRelay:
+    # Relays the data of every open tunnel on one thread
+    def __init__(self):
+        self.tunnels = set()
+        self._new = []  # tunnels added by other threads, not started yet
+        self._closed = False
+        self._lock = threading.Lock()
+        self._sel = selectors.DefaultSelector()
+        # Writing to _wakeUp interrupts select() when a tunnel is added
+        self._wakeUp, self._wakeUpReader = socketpair()
+        self._wakeUp.setblocking(False)
+        self._wakeUpReader.setblocking(False)
+        self._sel.register(self._wakeUpReader, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run, name='tunnels', daemon=True)
+        self._thread.start()
+
+    def add(self, tunnel, initial=b''):
+        # Starts relaying a tunnel. initial is data the client sent right
+        # after the CONNECT head; it is sent to the origin first.
+        if initial:
+            tunnel.origin.sendall(initial)
+            tunnel.upstream.nbytes += len(initial)
+        tunnel.client.setblocking(False)
+        tunnel.origin.setblocking(False)
+        with self._lock:
+            self._new.append(tunnel)
+        self._wake()
+
+    def close(self):
+        self._closed = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeUp.send(b'\0')
+        except BlockingIOError:
+            pass  # a wake up is already pending
+
+    def _run(self):
+        nextSweep = time.monotonic() + SWEEP_INTERVAL
+        while not self._closed:
+            timeout = max(0.0, nextSweep - time.monotonic()) if self.tunnels else None
+            touched = set()
+            for key, events in self._sel.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wakeUpReader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                key.data.handle(key.fileobj, events)
+                touched.add(key.data)
+            with self._lock:
+                new, self._new = self._new, []
+            self.tunnels.update(new)
+            touched.update(new)
+
+            now = time.monotonic()
+            if now >= nextSweep:
+                nextSweep = now + SWEEP_INTERVAL
+                for tunnel in self.tunnels:
+                    if now - tunnel.lastActivity >= tunnel.idleTimeout:
+                        tunnel.failed = True
+                        touched.add(tunnel)
+            for tunnel in touched:
+                try:
+                    if tunnel.done():
+                        self.tunnels.discard(tunnel)
+                        tunnel.close(self._sel)
+                    else:
+                        tunnel.watch(self._sel)
+                except Exception:
+                    # Never let one tunnel stop the relay of the others
+                    traceback.print_exc()
+                    self.tunnels.discard(tunnel)
+
+        for tunnel in self.tunnels:
+            tunnel.failed = True
+            tunnel.close(self._sel)
+        self._sel.close()
+
+
+class TunnelStats:
+    def __init__(self):
+        self.tunnels = 0
+        self.active = 0
+        self.failed = 0  # CONNECT requests refused or whose origin was unreachable
+        self.bytesUp = 0
+        self.bytesDown = 0
+        self._lock = threading.Lock()
+
+    def record_open(self):
+        with self._lock:
+            self.tunnels += 1
+            self.active += 1
+
+    def record_close(self, bytesUp, bytesDown):
+        with self._lock:
+            self.active -= 1
+            self.bytesUp += bytesUp
+            self.bytesDown += bytesDown
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def report(self):
+        with self._lock:
+            return ('Tunnels:\n'
+                    'Opened:         %d (%d active, %d failed)\n'
+                    'Bytes up:       %d\n'
+                    'Bytes down:     %d\n'
+                    % (self.tunnels, self.active, self.failed, self.bytesUp, self.bytesDown))